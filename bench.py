@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+    benchmarks for the textfree86 protocol, run locally
+
+    ./bench.py                      run everything
+    ./bench.py codec                run the benchmarks matching 'codec'
+    ./bench.py --json=out.json      save the results too
+    ./bench.py --compare=out.json   show the change from results saved before
+
+    round trips and file transfers talk to ./bench_cmd.py over a pipe
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from textfree86 import codec, wire, cli
+
+BENCH_CMD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_cmd.py')
+
+
+def timed(fn, n, repeat=5):
+    """best of several runs, to keep scheduler noise out of the figures"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(n)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def latencies(fn, n):
+    """time each of n calls, for the rate and the 50th and 99th percentiles"""
+    fn() # once untimed, to warm up
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        'ops': n / sum(times),
+        'p50_us': times[n // 2] * 1e6,
+        'p99_us': times[min(n - 1, n * 99 // 100)] * 1e6,
+    }
+
+
+def report(result):
+    parts = []
+    if 'us' in result:
+        parts.append("{:.1f} us/op".format(result['us']))
+    if 'ops' in result:
+        parts.append("{:.0f} ops/s".format(result['ops']))
+    if 'mb' in result:
+        parts.append("{:.1f} MB/s".format(result['mb']))
+    if 'p50_us' in result:
+        parts.append("p50 {:.1f} us, p99 {:.1f} us".format(result['p50_us'], result['p99_us']))
+    if 'sent' in result:
+        parts.append("{:.0f}% of the bytes sent".format(result['sent'] * 100))
+    return ", ".join(parts)
+
+
+def poll_frames():
+    """the frames of a poll-heavy session, as seen on the wire"""
+    frames = []
+    for idx in range(20):
+        frames.append(wire.Request("poll", 0, {'stdin': None}))
+        frames.append(wire.Session(0, idx, {'console': b'line %d\n' % idx}))
+    frames.append(wire.Request("poll", 0, {'stdin': b''}))
+    frames.append(wire.Response(0, None, file_handles={'console': b''}))
+    return frames
+
+
+def codec_bench(version):
+    frames = poll_frames()
+
+    def run(n):
+        for _ in range(n):
+            schema = {} if version > 2 else None
+            decoder = codec.Decoder()
+            for obj in frames:
+                if version == 1:
+                    buf = codec.dump(obj, bytearray())
+                else:
+                    buf = codec.dump_compact(obj, bytearray(), schema)
+                decoder.feed(b"%d\n" % len(buf))
+                decoder.feed(buf)
+
+    def bench(n):
+        seconds = timed(run, n)
+        count = n * len(frames)
+        return {'us': seconds / count * 1e6, 'ops': count / seconds}
+    return bench
+
+
+def tree(width=40, depth=2):
+    """a wide command tree, with flags on every command"""
+    def build(cmd, level):
+        for idx in range(width):
+            sub = cmd.subcommand("r{}".format(idx), "command {}".format(idx))
+            if level + 1 < depth:
+                build(sub, level + 1)
+            else:
+                @sub.run("--verbose? --output:str --tag:str... --limit:int --level:int src [dest] [rest...]")
+                def run(verbose, output, tag, limit, level, src, dest, rest):
+                    pass
+        return cmd
+    return build(cli.Command("root", "a wide tree"), 0)
+
+
+def tree_bench(version, action):
+    obj = tree().render()
+    if version == 1:
+        buf = bytes(codec.dump(obj, bytearray()))
+    else:
+        buf = bytes(codec.dump_compact(obj, bytearray(), {} if version > 2 else None))
+
+    def run(n):
+        for _ in range(n):
+            if action == 'parse':
+                codec.parse(buf)
+            elif version == 1:
+                codec.dump(obj, bytearray())
+            else:
+                codec.dump_compact(obj, bytearray(), {} if version > 2 else None)
+
+    def bench(n):
+        seconds = timed(run, n)
+        return {'us': seconds / n * 1e6, 'ops': n / seconds, 'mb': len(buf) * n / seconds / 1e6}
+    return bench
+
+
+def complete_bench(n):
+    # a completion is a fresh process, so each one reads the index from disk
+    tmp = tempfile.mkdtemp()
+    index = cli.CompletionIndex(os.path.join(tmp, "index"))
+    index.save(tree().render())
+    lines = [
+        ([], "r"),
+        ([], "r1"),
+        (["r7"], "r7"),
+        (["r7", "r7"], "--"),
+        (["r7", "r7"], "--l"),
+        (["r39", "r0"], "--tag"),
+    ]
+    state = {'idx': 0}
+
+    def complete():
+        path, text = lines[state['idx'] % len(lines)]
+        state['idx'] += 1
+        cli.CompletionIndex(index.path).complete(path, text)
+    try:
+        return latencies(complete, n)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def parse_args_bench(n):
+    obj = tree().render()
+    argv = ["r7", "r7", "--verbose", "--output=out", "--tag=a", "--tag=b", "--limit=10", "--level=3", "src", "dest", "x", "y"]
+    return latencies(lambda: obj.parse_args([], list(argv), {}), n)
+
+
+CHUNK = 256 * 1024
+
+def chunks(kind, count=32):
+    """infile chunks, either log-like text or random bytes"""
+    if kind == 'text':
+        data = b"".join(b"%d GET /index.html 200 %d\n" % (n, n * 7 % 1000) for n in range(count * CHUNK // 20))
+    else:
+        data = os.urandom(count * CHUNK)
+    return [data[i:i+CHUNK] for i in range(0, count * CHUNK, CHUNK)]
+
+
+def compress_bench(kind, method):
+    data = chunks(kind)
+
+    def run(n):
+        for _ in range(n):
+            schema = codec.Schema()
+            if method:
+                schema.compressor = codec.Compressor(method)
+            decoder = codec.Decoder()
+            for chunk in data:
+                buf = codec.dump_compact(wire.Request("poll", 0, {'file': [chunk]}), bytearray(), schema)
+                decoder.feed(b"%d\n" % len(buf))
+                decoder.feed(buf)
+        return schema
+
+    def bench(n):
+        seconds = timed(run, n)
+        schema = run(1)
+        size = sum(len(chunk) for chunk in data)
+        sent = schema.compressor.sent if method else size
+        return {'mb': size * n / seconds / 1e6, 'sent': sent / size}
+    return bench
+
+
+class Server:
+    """bench_cmd.py, run as a pipe server, with a client talking to it"""
+    def __enter__(self):
+        self.proc = subprocess.Popen([sys.executable, BENCH_CMD, '--pipe'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.client = cli.PipeClient(self.proc.stdin, self.proc.stdout)
+        self.client.render()
+        return self
+
+    def __exit__(self, *args):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+    def session(self, path, argv, infiles=None, stdin=None):
+        """call a command and poll it until it's done, like cli.run, returning the bytes written back"""
+        written = 0
+        stdin = cli.StdinReader(stdin.fileno()) if stdin else None
+        result = self.client.call(path, argv)
+        while isinstance(result, wire.Session):
+            for name, output in result.file_handles.items():
+                written += sum(len(buf) for buf in output) if isinstance(output, list) else len(output)
+            request = {}
+            if infiles:
+                request.update(cli.infile_chunks(infiles, result.credits))
+            if stdin:
+                request['stdin'] = stdin.read((result.credits or {}).get('stdin', 0))
+            result = self.client.poll(result.idx, request)
+        for output in result.file_handles.values():
+            written += sum(len(buf) for buf in output) if isinstance(output, list) else len(output)
+        return written
+
+
+def render_bench(n):
+    with Server() as server:
+        version = server.client.render().version()
+        return latencies(lambda: server.client.render(version), n)
+
+
+def call_bench(path):
+    def bench(n):
+        with Server() as server:
+            return latencies(lambda: server.session(path, {}), n)
+    return bench
+
+
+def infile_bench(n, megabytes=64):
+    with tempfile.NamedTemporaryFile() as fh:
+        fh.write(os.urandom(megabytes << 20))
+        fh.flush()
+        with Server() as server:
+            def run(n):
+                for _ in range(n):
+                    infiles = {'files': [open(fh.name, 'rb')]}
+                    server.session(["count"], {'files': [wire.FileHandle(fh.name, "read")]}, infiles)
+                    infiles['files'][0].close()
+            seconds = timed(run, n)
+    return {'mb': megabytes * n / seconds * 1.048576}
+
+
+def stdin_bench(n, megabytes=64):
+    with tempfile.NamedTemporaryFile() as fh:
+        fh.write(os.urandom(megabytes << 20))
+        fh.flush()
+        with Server() as server:
+            def run(n):
+                for _ in range(n):
+                    with open(fh.name, 'rb') as stdin:
+                        server.session(["drain"], {}, stdin=stdin)
+            seconds = timed(run, n)
+    return {'mb': megabytes * n / seconds * 1.048576}
+
+
+def outfile_bench(n, megabytes=64):
+    with Server() as server:
+        def run(n):
+            for _ in range(n):
+                server.session(["fill"], {'file': wire.FileHandle("out", "write"), 'megabytes': megabytes})
+        seconds = timed(run, n)
+    return {'mb': megabytes * n / seconds * 1.048576}
+
+
+def results_bench(n, count=100000):
+    with Server() as server:
+        def run(n):
+            for _ in range(n):
+                server.session(["seq"], {'count': count})
+        seconds = timed(run, n)
+    return {'ops': count * n / seconds}
+
+
+def console_bench(n, lines=100000):
+    with Server() as server:
+        def run(n):
+            for _ in range(n):
+                server.session(["yes"], {'count': lines, 'line': "y" * 63})
+        seconds = timed(run, n)
+    return {'mb': lines * 64 * n / seconds / 1e6}
+
+
+BENCHMARKS = [
+    ("codec v1 poll session", codec_bench(1), 500),
+    ("codec v2 poll session", codec_bench(2), 500),
+    ("codec v3 poll session", codec_bench(3), 500),
+    ("codec v1 dump tree", tree_bench(1, 'dump'), 5),
+    ("codec v3 dump tree", tree_bench(3, 'dump'), 5),
+    ("codec v1 parse tree", tree_bench(1, 'parse'), 5),
+    ("codec v3 parse tree", tree_bench(3, 'parse'), 5),
+    ("codec text chunks", compress_bench('text', None), 5),
+    ("codec text chunks zlib", compress_bench('text', 'zlib'), 5),
+    ("codec random chunks", compress_bench('random', None), 5),
+    ("codec random chunks zlib", compress_bench('random', 'zlib'), 5),
+    ("complete", complete_bench, 5000),
+    ("parse args", parse_args_bench, 5000),
+    ("round trip render", render_bench, 2000),
+    ("round trip thread call", call_bench(["tnop"]), 500),
+    ("round trip fork call", call_bench(["nop"]), 200),
+    ("infile throughput", infile_bench, 3),
+    ("stdin throughput", stdin_bench, 3),
+    ("outfile throughput", outfile_bench, 3),
+    ("console throughput", console_bench, 3),
+    ("result throughput", results_bench, 3),
+]
+
+
+def label():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(BENCH_CMD)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(old, new):
+    """the change in the main figure of a benchmark, higher is better"""
+    for key in ('ops', 'mb'):
+        if key in old and key in new:
+            return "{:+.0f}%".format((new[key] / old[key] - 1) * 100)
+    return ""
+
+
+def main(argv):
+    save = compare = None
+    names = []
+    for arg in argv:
+        if arg.startswith('--json='):
+            save = arg[7:]
+        elif arg.startswith('--compare='):
+            with open(arg[10:]) as fh:
+                compare = json.load(fh)['results']
+        elif arg in ('-h', '--help'):
+            print(__doc__.strip('\n'))
+            return 0
+        elif arg.startswith('-'):
+            print("unknown option: {}".format(arg), file=sys.stderr)
+            print(__doc__.strip('\n'), file=sys.stderr)
+            return 2
+        else:
+            names.append(arg)
+
+    unknown = [arg for arg in names if not any(arg in name for name, _, _ in BENCHMARKS)]
+    if unknown:
+        print("no benchmarks match: {}".format(", ".join(unknown)), file=sys.stderr)
+        return 2
+
+    results = {}
+    for name, bench, n in BENCHMARKS:
+        if names and not any(arg in name for arg in names):
+            continue
+        results[name] = result = bench(n)
+        line = "{:<30} {}".format(name, report(result))
+        if compare and name in compare:
+            line = "{:<100} {}".format(line, change(compare[name], result))
+        print(line, flush=True)
+
+    if save:
+        with open(save, 'w') as fh:
+            json.dump({
+                'label': label(),
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': results,
+            }, fh, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""commands for bench.py to time, which work as examples too"""
+import sys
+
+from textfree86 import cli
+
+root = cli.Command('bench', 'commands to benchmark the protocol with')
+
+nop = root.subcommand('nop', 'do nothing, in a fork')
+@nop.run()
+def nop_run():
+    pass
+
+tnop = root.subcommand('tnop', 'do nothing, in a thread')
+@tnop.run(backend="thread")
+def tnop_run():
+    pass
+
+count = root.subcommand('count', 'count the bytes in files')
+@count.run("files:infile...")
+def count_run(files):
+    total = 0
+    for file in files:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            total += len(chunk)
+    return total
+
+drain = root.subcommand('drain', 'count the bytes sent to stdin')
+@drain.run()
+def drain_run():
+    total = 0
+    for chunk in iter(lambda: sys.stdin.buffer.read(1 << 20), b''):
+        total += len(chunk)
+    return total
+
+fill = root.subcommand('fill', 'write megabytes of zeros to a file')
+@fill.run("file:outfile megabytes:int")
+def fill_run(file, megabytes):
+    block = bytes(1 << 20)
+    for _ in range(megabytes):
+        file.write(block)
+
+seq = root.subcommand('seq', 'yield the numbers up to count, one result each')
+@seq.run("count:int")
+def seq_run(count):
+    for n in range(count):
+        yield n
+
+yes = root.subcommand('yes', 'print a line, over and over')
+@yes.run("count:int [line:str]")
+def yes_run(count, line):
+    line = (line or "y") + "\n"
+    for _ in range(count):
+        sys.stdout.write(line)
+
+root.main(__name__)
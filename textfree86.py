@@ -1,12 +1,38 @@
 #!/usr/bin/env python3
 
 import io
+import json
 import os
 import sys
 import time
 import types
+import stat
+import zlib
+import struct
+import hashlib
+import inspect
+import asyncio
+import traceback
+import contextvars
+import concurrent.futures
 import itertools
+import collections
+import shlex
+import socket
+import signal
+import selectors
+import threading
 import subprocess
+try:
+    import lzma
+except ImportError: # python can be built without it
+    lzma = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+import http.client
+import urllib.parse
 
 
 ARGTYPES=[x.strip() for x in """
@@ -147,7 +173,7 @@ def parse_argspec(argspec):
     
     # check names are valid identifiers
 
-    return nargs, wire.Argspec(
+    spec = wire.Argspec(
             switches = switches,
             flags = flags,
             lists = lists,
@@ -157,194 +183,205 @@ def parse_argspec(argspec):
             argtypes = argtypes,
             descriptions = descriptions,
     )
+    spec.matcher() # compiled now, so a bad argtype shows up early
+    return nargs, spec
 
 
 def parse_args(argspec, argv, environ):
-    options = []
-    flags = {}
-    args = {}
-    file_handles = {}
-
-    for arg in argv:
-        if arg.startswith('--'):
-            if '=' in arg:
-                key, value = arg[2:].split('=',1)
-            else:
-                key, value = arg[2:], None
-            if key not in flags:
-                flags[key] = []
-            flags[key].append(value)
-        else:
-            options.append(arg)
-
-    for name in argspec.switches:
-        args[name] = False
-        if name not in flags:
-            continue
-
-        values = flags.pop(name)
-
-        if not values: 
-            raise wire.BadArg("value given for switch flag {}".format(name))
-        if len(values) > 1:
-            raise wire.BadArg("duplicate switch flag for: {}".format(name, ", ".join(repr(v) for v in values)))
-
-        if values[0] is None:
-            args[name] = True
-        else:
-            args[name] = try_parse(name, values[0], "boolean")
-
-    for name in argspec.flags:
-        args[name] = None
-        if name not in flags:
-            continue
-
-        values = flags.pop(name)
-        if not values or values[0] is None:
-            raise wire.BadArg("missing value for option flag {}".format(name))
-        if len(values) > 1:
-            raise wire.BadArg("duplicate option flag for: {}".format(name, ", ".join(repr(v) for v in values)))
-
-        args[name] = try_parse(name, value, argspec.argtypes.get(name))
-
-    for name in argspec.lists:
-        args[name] = []
-        if name not in flags:
-            continue
-
-        values = flags.pop(name)
-        if not values or None in values:
-            raise wire.BadArg("missing value for list flag {}".format(name))
-
-        for value in values:
-            args[name].append(try_parse(name, value, argspec.argtypes.get(name)))
-
-    named_args = False
-    if flags:
-        for name in argspec.positional:
-            if name in flags:
-                named_args = True
-                break
-        for name in argspec.optional:
-            if name in flags:
-                named_args = True
-                break
-        if argspec.tail in flags:
-            named_args = True
-                
-    if named_args:
-        for name in argspec.positional:
-            args[name] = None
-            if name not in flags:
-                raise BadArg("missing named option: {}".format(name))
-
-            values = flags.pop(name)
-            if not values or values[0] is None:
-                raise wire.BadArg("missing value for named option {}".format(name))
-            if len(values) > 1:
-                raise wire.BadArg("duplicate named option for: {}".format(name, ", ".join(repr(v) for v in values)))
+    return argspec.matcher().parse(argv)
 
-            args[name] = try_parse(name, value, argspec.argtypes.get(name))
+class ArgMatcher:
+    """
+        an Argspec compiled for parse_args: a table of each name's kind and
+        parser, so argv is matched in a single pass, in linear time
 
-        for name in argspec.optional:
+        flags are looked up as they are found, positional and optional args
+        are taken by index, and the tail is whatever is left over
+    """
+    SWITCH, FLAG, LIST, POSITIONAL, OPTIONAL, TAIL = range(6)
+
+    def __init__(self, argspec):
+        self.argspec = argspec
+        self.slots = {} # name -> (kind, parser)
+        kinds = (
+            (self.SWITCH, argspec.switches),
+            (self.FLAG, argspec.flags),
+            (self.LIST, argspec.lists),
+            (self.POSITIONAL, argspec.positional),
+            (self.OPTIONAL, argspec.optional),
+            (self.TAIL, [argspec.tail] if argspec.tail else []),
+        )
+        for kind, names in kinds:
+            for name in names:
+                argtype = "boolean" if kind == self.SWITCH else argspec.argtypes.get(name)
+                self.slots[name] = (kind, parser_for(argtype))
+        self.positional = [(name, self.slots[name][1]) for name in argspec.positional]
+        self.optional = [(name, self.slots[name][1]) for name in argspec.optional]
+        self.tail = self.slots[argspec.tail][1] if argspec.tail else None
+
+    def complete(self, prefix):
+        """the switches, then flags, then lists starting with prefix, as they'd be typed"""
+        argspec = self.argspec
+        out = []
+        out.extend("--{}".format(x) for x in argspec.switches if x.startswith(prefix))
+        out.extend("--{}=".format(x) for x in argspec.flags if x.startswith(prefix))
+        out.extend("--{}=".format(x) for x in argspec.lists if x.startswith(prefix))
+        return out
+
+    def parse(self, argv):
+        argspec = self.argspec
+        args = {}
+        for name in argspec.switches:
+            args[name] = False
+        for name in argspec.flags:
             args[name] = None
-            if name not in flags:
-                continue
-
-            values = flags.pop(name)
-            if not values or values[0] is None:
-                raise wire.BadArg("missing value for named option {}".format(name))
-            if len(values) > 1:
-                raise wire.BadArg("duplicate named option for: {}".format(name, ", ".join(repr(v) for v in values)))
-
-            args[name] = try_parse(value, argspec.argtypes.get(name))
-
-        name = argspec.tail
-        if name and name in flags:
+        for name in argspec.lists:
             args[name] = []
 
-            values = flags.pop(name)
-            if not values or None in values:
-                raise wire.BadArg("missing value for named option  {}".format(name))
-
-            for v in values:
-                args[name].append(try_parse(name, value, argspec.argtypes.get(name)))
-    else:
-        if flags:
-            raise wire.BadArg("unknown option flags: --{}".format("".join(flags)))
-
-        if argspec.positional:
-            for name in argspec.positional:
-                if not options: 
-                    raise wire.BadArg("missing option: {}".format(name))
-
-                args[name] = try_parse(name, options.pop(0),argspec.argtypes.get(name))
-
-        if argspec.optional:
-            for name in argspec.optional:
-                if not options: 
-                    args[name] = None
+        seen = set() # switches and flags given, as they can only be given once
+        named = {} # positional, optional, and tail args given as flags
+        unknown = []
+        options = []
+        for arg in argv:
+            if not arg.startswith('--'):
+                options.append(arg)
+                continue
+            name, equals, value = arg[2:].partition('=')
+            if not equals:
+                value = None
+            slot = self.slots.get(name)
+            if slot is None:
+                unknown.append(name)
+                continue
+            kind, parser = slot
+            if kind == self.SWITCH:
+                if name in seen:
+                    raise wire.BadArg("duplicate switch flag for: {}".format(name))
+                seen.add(name)
+                args[name] = True if value is None else parser(name, value)
+            elif kind == self.FLAG:
+                if value is None:
+                    raise wire.BadArg("missing value for option flag {}".format(name))
+                if name in seen:
+                    raise wire.BadArg("duplicate option flag for: {}".format(name))
+                seen.add(name)
+                args[name] = parser(name, value)
+            elif kind == self.LIST:
+                if value is None:
+                    raise wire.BadArg("missing value for list flag {}".format(name))
+                args[name].append(parser(name, value))
+            else:
+                if value is None:
+                    raise wire.BadArg("missing value for named option {}".format(name))
+                if kind == self.TAIL:
+                    named.setdefault(name, []).append(parser(name, value))
+                elif name in named:
+                    raise wire.BadArg("duplicate named option for: {}".format(name))
                 else:
-                    args[name] = try_parse(name, options.pop(0), argspec.argtypes.get(name))
-
+                    named[name] = parser(name, value)
+
+        if unknown:
+            raise wire.BadArg("unknown option flags: {}".format(", ".join("--{}".format(name) for name in dict.fromkeys(unknown))))
+
+        if named:
+            if options:
+                raise wire.BadArg("unnamed options given {!r}".format(" ".join(options)))
+            for name, _ in self.positional:
+                if name not in named:
+                    raise wire.BadArg("missing named option: {}".format(name))
+                args[name] = named[name]
+            for name, _ in self.optional:
+                args[name] = named.get(name)
+            if argspec.tail:
+                args[argspec.tail] = named.get(argspec.tail, [])
+            return args
+
+        if len(options) < len(self.positional):
+            raise wire.BadArg("missing option: {}".format(self.positional[len(options)][0]))
+        idx = 0
+        for name, parser in self.positional:
+            args[name] = parser(name, options[idx])
+            idx += 1
+        for name, parser in self.optional:
+            if idx < len(options):
+                args[name] = parser(name, options[idx])
+                idx += 1
+            else:
+                args[name] = None
         if argspec.tail:
-            tail = []
-            name = argspec.tail
-            tailtype = argspec.argtypes.get(name)
-            while options:
-                tail.append(try_parse(name, options.pop(0), tailtype))
-
-            args[name] = tail
-
-    if options and named_args:
-        raise wire.BadArg("unnamed options given {!r}".format(" ".join(options)))
-    if options:
-        raise wire.BadArg("unrecognised option: {!r}".format(" ".join(options)))
-    return args
+            name, parser = argspec.tail, self.tail
+            if parser is parse_str:
+                args[name] = options[idx:]
+            else:
+                args[name] = [parser(name, arg) for arg in options[idx:]]
+        elif idx < len(options):
+            raise wire.BadArg("unrecognised option: {!r}".format(" ".join(options[idx:])))
+        return args
+
+def parse_str(name, arg):
+    return arg
+
+def parse_int(name, arg):
+    try:
+        i = int(arg)
+        if str(i) == arg: return i
+    except ValueError:
+        pass
+    raise wire.BadArg('{} expects an integer, got {}'.format(name, arg))
+
+def parse_float(name, arg):
+    try:
+        i = float(arg)
+        if str(i) == arg: return i
+    except ValueError:
+        pass
+    raise wire.BadArg('{} expects an floating-point number, got {}'.format(name, arg))
+
+def parse_bool(name, arg):
+    if arg == "true":
+        return True
+    elif arg == "false":
+        return False
+    raise wire.BadArg('{} expects either true or false, got {}'.format(name, arg))
+
+def parse_scalar(name, arg):
+    try:
+        i = int(arg)
+        if str(i) == arg: return i
+    except ValueError:
+        pass
+    try:
+        f = float(arg)
+        if str(f) == arg: return f
+    except ValueError:
+        pass
+    return arg
+
+PARSERS = {
+    None: parse_scalar,
+    "scalar": parse_scalar,
+    "str": parse_str,
+    "string": parse_str,
+    "int": parse_int,
+    "integer": parse_int,
+    "float": parse_float,
+    "num": parse_float,
+    "number": parse_float,
+    "bool": parse_bool,
+    "boolean": parse_bool,
+    "infile": lambda name, arg: wire.FileHandle(arg, "read"),
+    "outfile": lambda name, arg: wire.FileHandle(arg, "write"),
+}
+
+def parser_for(argtype):
+    parser = PARSERS.get(argtype)
+    if parser is None:
+        def parser(name, arg):
+            raise wire.BadArg("Don't know how to parse option {}, of unknown type {}".format(name, argtype))
+    return parser
 
 def try_parse(name, arg, argtype):
-    if argtype in ("str", "string"):
-        return arg
-    elif argtype == "infile":
-        return wire.FileHandle(arg, "read")
-    elif argtype == "outfile":
-        return wire.FileHandle(arg, "write")
-
-    elif argtype in ("int","integer"):
-        try:
-            i = int(arg)
-            if str(i) == arg: return i
-        except:
-            pass
-        raise wire.BadArg('{} expects an integer, got {}'.format(name, arg))
-
-    elif argtype in ("float","num", "number"):
-        try:
-            i = float(arg)
-            if str(i) == arg: return i
-        except:
-            pass
-        raise wire.BadArg('{} expects an floating-point number, got {}'.format(name, arg))
-    elif argtype in ("bool", "boolean"):
-        if arg == "true":
-            return True
-        elif arg == "false":
-            return False
-        raise wire.BadArg('{} expects either true or false, got {}'.format(name, arg))
-    elif not argtype or argtype == "scalar":
-        try:
-            i = int(arg)
-            if str(i) == arg: return i
-        except:
-            pass
-        try:
-            f = float(arg)
-            if str(f) == arg: return f
-        except:
-            pass
-        return arg
-    else:
-        raise wire.BadArg("Don't know how to parse option {}, of unknown type {}".format(name, argtype))
+    return parser_for(argtype)(name, arg)
 
 class codec:
     """
@@ -363,16 +400,44 @@ class codec:
 
         note: 0..31 and 128..255 are not used as types for a reason
         
+        version 2 adds compact types, and parse() accepts both versions.
+        a <varint> is an unsigned LEB128 number, low seven bits first
+
+        int 0..31 = "\x00" .. "\x1f"
+        int = "+" <width as byte> <big-endian bytes>, i.e "+\x01\x20" for 32
+        int = "-" <width as byte> <big-endian bytes of -n>, i.e "-\x01\x7F" for -127
+        float = "F" <ieee-754 double, big-endian>
+        bytes = "B" <varint length> <bytes>
+        string = "U" <varint length> <utf-8 bytes>
+        list = "l" <varint entries> (<encoded value>)*
+        record = "r" <varint pairs> (<encoded key> <encoded value>)*
+        tag = "t" <varint length> <name as printable ascii> <encoded value>
+
+        version 3 numbers registered classes and their fields, once per 
+        connection. the first time a class is sent, a schema gives it the
+        next number, and from then on its objects are sent as a struct, 
+        with the values of each field in the order the schema lists them
+
+        schema = "S" <varint number> <varint length> <name> <varint fields> (<varint length> <field name>)*
+        struct = "s" <varint number> (<encoded value>)*
+
+        when a connection agrees to compression, large bytes values may be 
+        sent compressed, with "z" for zlib, "x" for lzma, or "j" for bz2
+
+        bytes = "Z" <method> <varint original length> <varint length> <compressed bytes>
+
         stretch goals:
             use utf-8 codepoint as type, as high bit is reserved
-            encode ints 0..31 as types \x00 .. \x1f
-            types for pos int, neg int, float that use <width as codepoint> <bytes>
-                i.e "+\x01\x20 for 32, "-\x01\x7F" as -127
-            types to define numbers for tag/field names in records, 
 
     """
+    VERSION = 3
     tags = {}
     classes = {}
+    defaults = {}
+    fields = {}
+    records = {}
+    structs = {}
+    builders = {}
     TRUE = ord("y")
     FALSE = ord("n")
     NULL = ord("z")
@@ -385,69 +450,425 @@ class codec:
     TAG = ord("T")
     END = 127
 
-    def parse(buf, offset=0):
+    POS_INT = ord("+")
+    NEG_INT = ord("-")
+    DOUBLE = ord("F")
+    BLOB = ord("B")
+    TEXT = ord("U")
+    ARRAY = ord("l")
+    TABLE = ord("r")
+    OBJECT = ord("t")
+    SCHEMA = ord("S")
+    STRUCT = ord("s")
+    ZIPPED = ord("Z")
+
+    methods = {} # name -> (method byte, compress(data, level), decompressor())
+    methods['zlib'] = (ord("z"), zlib.compress, zlib.decompressobj)
+    if lzma:
+        methods['lzma'] = (ord("x"), lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor)
+    if bz2:
+        methods['bz2'] = (ord("j"), bz2.compress, bz2.BZ2Decompressor)
+    decompressors = {byte: decompressor for byte, _, decompressor in methods.values()}
+
+    def varint(n, buf):
+        while n > 0x7F:
+            buf.append((n & 0x7F) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    MORE = object() # returned by resume() when the buffer ends mid-value
+
+    def parse_varint(buf, offset, limit):
+        n = shift = 0
+        while offset < limit:
+            byte = buf[offset]
+            offset += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n, offset
+            shift += 7
+        return None
+
+    def find_end(buf, offset, limit):
+        """the offset of the next END byte before limit or -1, scanning in place over a memoryview"""
+        if isinstance(buf, memoryview):
+            while offset < limit:
+                if buf[offset] == codec.END:
+                    return offset
+                offset += 1
+            return -1
+        return buf.find(codec.END, offset, limit)
+
+    def parse_decimal(buf, offset, limit):
+        """an ascii integer ending in END, returning it and the offset after END"""
+        if not isinstance(buf, memoryview):
+            end = buf.find(codec.END, offset, limit)
+            if end < 0:
+                return None
+            return int(buf[offset:end]), end+1
+        n, sign = 0, 1
+        if offset < limit and buf[offset] == 45: # '-'
+            sign, offset = -1, offset+1
+        while offset < limit:
+            byte = buf[offset]
+            if byte == codec.END:
+                return sign*n, offset+1
+            if not 48 <= byte <= 57:
+                raise Exception('bad digit {!r}'.format(chr(byte)))
+            n = n*10 + byte - 48
+            offset += 1
+        return None
+
+    def token(buf, offset, limit):
+        """
+            reads one type byte and its payload from buf[offset:limit]
+
+            returns (None, value, end) for a scalar, (type, size, end) for the
+            start of a list or record, (type, class, end) for the start of a
+            tag, (type, number, end) for the start of a struct, (type, (number,
+            name, fields), end) for a schema, or None when the payload isn't 
+            all there yet
+        """
+        if offset >= limit:
+            return None
         peek = buf[offset]
-        if peek == codec.TRUE:
-            return True, offset+1
+        if peek < 32:
+            return None, peek, offset+1
+        elif peek == codec.TEXT or peek == codec.BLOB:
+            size = codec.parse_varint(buf, offset+1, limit)
+            if size is None or size[0] + size[1] > limit:
+                return None
+            size, start = size
+            obj = buf[start:start+size]
+            if peek == codec.TEXT:
+                obj = str(obj, 'utf-8')
+            return None, obj, start+size
+        elif peek == codec.ZIPPED:
+            if offset+2 > limit:
+                return None
+            size = codec.parse_varint(buf, offset+2, limit)
+            if size is None:
+                return None
+            size, start = size
+            length = codec.parse_varint(buf, start, limit)
+            if length is None or length[0] + length[1] > limit:
+                return None
+            length, start = length
+            decompressor = codec.decompressors[buf[offset+1]]()
+            obj = decompressor.decompress(buf[start:start+length], size+1)
+            if len(obj) != size:
+                raise Exception('bad buf, compressed bytes are not {} long'.format(size))
+            return None, obj, start+length
+        elif peek == codec.POS_INT or peek == codec.NEG_INT:
+            if offset+2 > limit or offset+2+buf[offset+1] > limit:
+                return None
+            start = offset+2
+            end = start + buf[offset+1]
+            obj = int.from_bytes(buf[start:end], 'big')
+            return None, (obj if peek == codec.POS_INT else -obj), end
+        elif peek == codec.DOUBLE:
+            if offset+9 > limit:
+                return None
+            return None, struct.unpack_from('>d', buf, offset+1)[0], offset+9
+        elif peek == codec.ARRAY or peek == codec.TABLE:
+            size = codec.parse_varint(buf, offset+1, limit)
+            if size is None:
+                return None
+            return peek, size[0], size[1]
+        elif peek == codec.OBJECT:
+            size = codec.parse_varint(buf, offset+1, limit)
+            if size is None or size[0] + size[1] > limit:
+                return None
+            size, start = size
+            return peek, codec.classes[str(buf[start:start+size], 'ascii')], start+size
+        elif peek == codec.STRUCT:
+            number = codec.parse_varint(buf, offset+1, limit)
+            if number is None:
+                return None
+            return peek, number[0], number[1]
+        elif peek == codec.SCHEMA:
+            number = codec.parse_varint(buf, offset+1, limit)
+            if number is None:
+                return None
+            number, start = number
+            names = []
+            count = 1
+            while count:
+                size = codec.parse_varint(buf, start, limit)
+                if size is None or size[0] + size[1] > limit:
+                    return None
+                size, start = size
+                names.append(str(buf[start:start+size], 'utf-8'))
+                start += size
+                if len(names) == 1:
+                    count = codec.parse_varint(buf, start, limit)
+                    if count is None:
+                        return None
+                    count, start = count
+                else:
+                    count -= 1
+            return peek, (number, names[0], names[1:]), start
+        elif peek == codec.TRUE:
+            return None, True, offset+1
         elif peek == codec.FALSE:
-            return False, offset+1
+            return None, False, offset+1
         elif peek == codec.NULL:
-            return None, offset+1
+            return None, None, offset+1
         elif peek == codec.INT:
-            end = buf.index(codec.END, offset+1)
-            obj = buf[offset+1:end].decode('ascii')
-            return int(obj), end+1
+            obj = codec.parse_decimal(buf, offset+1, limit)
+            if obj is None:
+                return None
+            return None, obj[0], obj[1]
         elif peek == codec.FLOAT:
-            end = buf.index(codec.END, offset+1)
-            obj = buf[offset+1:end].decode('ascii')
-            return float.fromhex(obj), end+1
-        elif peek == codec.BYTES:
-            end = buf.index(codec.END, offset+1)
-            size = int(buf[offset+1:end].decode('ascii'))
-            start, end = end+1, end+1+size
+            end = codec.find_end(buf, offset+1, limit)
+            if end < 0:
+                return None
+            return None, float.fromhex(str(buf[offset+1:end], 'ascii')), end+1
+        elif peek == codec.BYTES or peek == codec.STRING:
+            size = codec.parse_decimal(buf, offset+1, limit)
+            if size is None or size[0] + size[1] >= limit:
+                return None
+            size, start = size
+            end = start+size
+            if buf[end] != codec.END:
+                raise Exception('bad buf, missing end after {} bytes'.format(size))
             obj = buf[start:end]
-            end = buf.index(codec.END, end)
-            return obj, end+1
-        elif peek == codec.STRING:
-            end = buf.index(codec.END, offset+1)
-            size = int(buf[offset+1:end].decode('ascii'))
-            start, end = end+1, end+1+size
-            obj = buf[start:end].decode('utf-8')
-            end = buf.index(codec.END, end)
-            return obj, end+1
-        elif peek == codec.LIST:
-            end = buf.index(codec.END, offset+1)
-            size = int(buf[offset+1:end].decode('ascii'))
-            start = end+1
-            out = []
-            for _ in range(size):
-                value, start = codec.parse(buf, start)
-                out.append(value)
-            end = buf.index(codec.END, start)
-            return out, end+1
-        elif peek == codec.RECORD:
-            end = buf.index(codec.END, offset+1)
-            size = int(buf[offset+1:end].decode('ascii'))
-            start = end+1
-            out = {}
-            for _ in range(size):
-                key, start = codec.parse(buf, start)
-                value, start = codec.parse(buf, start)
-                out[key] = value
-
-            end = buf.index(codec.END, start)
-            return out, end+1
+            if peek == codec.STRING:
+                obj = str(obj, 'utf-8')
+            return None, obj, end+1
+        elif peek == codec.LIST or peek == codec.RECORD:
+            size = codec.parse_decimal(buf, offset+1, limit)
+            if size is None:
+                return None
+            return peek, size[0], size[1]
         elif peek == codec.TAG:
-            end = buf.index(codec.END, offset+1)
-            tag = (buf[offset+1:end].decode('ascii'))
-            cls = codec.classes[tag]
-            args, start = codec.parse(buf, end+1)
-            out = cls(**args)
-            end = buf.index(codec.END, start)
-            return out, end+1
+            end = codec.find_end(buf, offset+1, limit)
+            if end < 0:
+                return None
+            return peek, codec.classes[str(buf[offset+1:end], 'ascii')], end+1
 
+        raise Exception('bad buf {!r}'.format(chr(peek)))
+
+    def resume(buf, offset, limit, stack, schema=None):
+        """
+            decodes one value from buf[offset:limit], carrying on from a stack 
+            of unfinished lists, records, and tags left by an earlier call
+
+            returns the value and the offset after it, or codec.MORE and the 
+            offset reached, leaving the stack to pass in with more bytes.
+
+            schema maps struct numbers to (build function, field count), and is 
+            added to as schemas are read, so one dict is used per connection
+        """
+        while True:
+            if stack and stack[-1][2] == 0:
+                kind, obj, _, extra = stack[-1]
+                if kind == codec.LIST or kind == codec.RECORD or kind == codec.TAG:
+                    if offset >= limit:
+                        return codec.MORE, offset
+                    if buf[offset] != codec.END:
+                        raise Exception('bad buf, missing end of {!r}'.format(chr(kind)))
+                    offset += 1
+                stack.pop()
+                if kind == codec.STRUCT:
+                    value = extra(obj)
+                elif kind == codec.TAG or kind == codec.OBJECT:
+                    value = extra(**obj)
+                else:
+                    value = obj
+            else:
+                token = codec.token(buf, offset, limit)
+                if token is None:
+                    return codec.MORE, offset
+                kind, value, offset = token
+                if kind == codec.ARRAY or kind == codec.LIST:
+                    stack.append([kind, [], value, None])
+                    continue
+                elif kind == codec.TABLE or kind == codec.RECORD:
+                    stack.append([kind, {}, 2*value, codec.MORE]) # extra is the pending key
+                    continue
+                elif kind == codec.STRUCT:
+                    build, count = schema[value]
+                    stack.append([kind, [], count, build])
+                    continue
+                elif kind == codec.SCHEMA:
+                    codec.learn(schema, value)
+                    continue
+                elif kind is not None:
+                    stack.append([kind, None, 1, value]) # extra is the class
+                    continue
+
+            if not stack:
+                return value, offset
+            top = stack[-1]
+            kind = top[0]
+            if kind == codec.ARRAY or kind == codec.LIST or kind == codec.STRUCT:
+                top[1].append(value)
+            elif kind == codec.TABLE or kind == codec.RECORD:
+                if top[3] is codec.MORE:
+                    top[3] = bytes(value) if isinstance(value, memoryview) else value # views can't be hashed
+                else:
+                    top[1][top[3]] = value
+                    top[3] = codec.MORE
+            else:
+                top[1] = value
+            top[2] -= 1
+
+    def learn(schema, value):
+        """add a schema read from the buffer, (number, name, fields), to the ones for this connection"""
+        number, name, names = value
+        cls = codec.classes[name]
+        if names == codec.fields[cls]:
+            build = codec.builders[cls]
+        else:
+            build = lambda values, cls=cls, names=names: cls(**dict(zip(names, values)))
+        schema[number] = (build, len(names))
+
+    def whole(buf, offset, limit, schema):
+        """
+            decodes one value from buf[offset:limit], when all of it is there
+
+            the same as resume(), but recursive rather than keeping a stack,
+            which is quicker when a value needn't be picked up part way
+        """
+        token = codec.token(buf, offset, limit)
+        if token is None:
+            raise Exception('bad buf, truncated at {}'.format(offset))
+        kind, value, offset = token
+        if kind is None:
+            return value, offset
+        if kind == codec.ARRAY or kind == codec.LIST:
+            out = []
+            for _ in range(value):
+                item, offset = codec.whole(buf, offset, limit, schema)
+                out.append(item)
+        elif kind == codec.TABLE or kind == codec.RECORD:
+            out = {}
+            for _ in range(value):
+                key, offset = codec.whole(buf, offset, limit, schema)
+                if isinstance(key, memoryview):
+                    key = bytes(key) # views can't be hashed
+                out[key], offset = codec.whole(buf, offset, limit, schema)
+        elif kind == codec.STRUCT:
+            build, count = schema[value]
+            values = []
+            for _ in range(count):
+                item, offset = codec.whole(buf, offset, limit, schema)
+                values.append(item)
+            return build(values), offset
+        elif kind == codec.SCHEMA:
+            codec.learn(schema, value)
+            return codec.whole(buf, offset, limit, schema) # the struct it was sent ahead of
+        else: # a tag or object, and its class
+            args, offset = codec.whole(buf, offset, limit, schema)
+            out = value(**args)
+        if kind == codec.LIST or kind == codec.RECORD or kind == codec.TAG:
+            if offset >= limit or buf[offset] != codec.END:
+                raise Exception('bad buf, missing end of {!r}'.format(chr(kind)))
+            offset += 1
+        return out, offset
+
+    def parse(buf, offset=0, schema=None):
+        """
+            decodes the value at offset, returning it and the offset after it
+
+            when buf is a memoryview, bytes values come back as views into it
+            rather than copies, and numbers are decoded in place
+        """
+        return codec.whole(buf, offset, len(buf), {} if schema is None else schema)
+
+    class Decoder:
+        """
+            an incremental decoder for a stream of length-prefixed frames
+
+            feed() takes bytes as they arrive and returns any objects finished, 
+            values are built up as their bytes come in, with the open lists and
+            records kept on an explicit stack between calls. bytes values are
+            views into the buffer, which is swapped out rather than resized
+            while they are still around, so they never change underneath the
+            caller. keys are copied out as bytes, as a view can't be hashed.
+
+            when nothing is held over from the last call, whole frames are
+            decoded straight from data, when it is immutable bytes, and only
+            a partial frame left at the end is copied into the buffer
+        """
+        def __init__(self):
+            self.buf = bytearray()
+            self.pos = 0
+            self.end = None # where the current frame ends
+            self.stack = []
+            self.schema = {}
+            self.closed = False
+
+        def feed_whole(self, data, out):
+            """decode the whole frames at the start of data, returning where the rest begins"""
+            pos = 0
+            view = memoryview(data)
+            try:
+                while not self.closed:
+                    line_end = data.find(b"\n", pos)
+                    if line_end < 0:
+                        break
+                    line = data[pos:line_end].strip()
+                    size = int(line) if line else -1
+                    if size < 0:
+                        self.closed = True
+                        pos = line_end + 1
+                        break
+                    end = line_end + 1 + size
+                    if end > len(data):
+                        break # left for the buffer
+                    value, offset = codec.whole(view, line_end + 1, end, self.schema)
+                    if offset != end:
+                        raise Exception('bad frame, {} bytes left over'.format(end - offset))
+                    out.append(value)
+                    pos = end
+            finally:
+                view.release()
+            return pos
+
+        def feed(self, data):
+            if self.pos == len(self.buf) and self.end is None and not self.stack and isinstance(data, bytes):
+                out = []
+                pos = self.feed_whole(data, out)
+                if pos == len(data) or self.closed:
+                    return out
+                return out + self.feed(memoryview(data)[pos:])
+            try:
+                del self.buf[:self.pos]
+                self.buf.extend(data)
+            except BufferError: 
+                self.buf = self.buf[self.pos:]
+                self.buf.extend(data)
+            if self.end is not None:
+                self.end -= self.pos
+            self.pos = 0
 
-        raise Exception('bad buf {}'.format(peek.encode('ascii')))
+            out = []
+            view = memoryview(self.buf)
+            try:
+                while not self.closed:
+                    if self.end is None:
+                        line_end = self.buf.find(b"\n", self.pos)
+                        if line_end < 0:
+                            break
+                        line = self.buf[self.pos:line_end].strip()
+                        self.pos = line_end + 1
+                        size = int(line) if line else -1 # blank line means it's probably over
+                        if size < 0:
+                            self.closed = True
+                            break
+                        self.end = self.pos + size
+                    value, self.pos = codec.resume(view, self.pos, min(self.end, len(self.buf)), self.stack, self.schema)
+                    if value is codec.MORE:
+                        break
+                    if self.pos != self.end:
+                        raise Exception('bad frame, {} bytes left over'.format(self.end - self.pos))
+                    self.end = None
+                    out.append(value)
+            finally:
+                view.release()
+            return out
 
 
     def dump(obj, buf):
@@ -462,10 +883,10 @@ class codec:
             buf.extend(str(obj).encode('ascii'))
             buf.append(codec.END)
         elif isinstance(obj, float):
-            buf.append(codec.INT)
+            buf.append(codec.FLOAT)
             buf.extend(float.hex(obj).encode('ascii'))
             buf.append(codec.END)
-        elif isinstance(obj, (bytes,bytearray)):
+        elif isinstance(obj, (bytes,bytearray,memoryview)):
             buf.append(codec.BYTES)
             buf.extend(str(len(obj)).encode('ascii'))
             buf.append(codec.END)
@@ -498,27 +919,202 @@ class codec:
             buf.append(codec.TAG)
             buf.extend(tag)
             buf.append(codec.END)
-            codec.dump(obj.__dict__, buf)
+            # fields left at their default are skipped, so older peers
+            # can still build objects that have gained new fields
+            codec.dump(codec.records[obj.__class__](obj), buf)
             buf.append(codec.END)
         else:
             raise Exception('bad obj {!r}'.format(obj))
         return buf
 
+    def dump_compact(obj, buf, schema=None):
+        """
+            writes obj in the version 2 encoding, or version 3 when given a
+            schema dict, which maps classes already sent to their numbers
+        """
+        if schema is not None and obj.__class__ in codec.structs:
+            cls = obj.__class__
+            number = schema.get(cls)
+            if number is None:
+                number = schema[cls] = len(schema)
+                names = codec.fields[cls]
+                buf.append(codec.SCHEMA)
+                codec.varint(number, buf)
+                for idx, name in enumerate([codec.tags[cls]] + names):
+                    name = name.encode('utf-8')
+                    codec.varint(len(name), buf)
+                    buf.extend(name)
+                    if idx == 0:
+                        codec.varint(len(names), buf)
+            buf.append(codec.STRUCT)
+            codec.varint(number, buf)
+            codec.structs[cls](obj, buf, schema, codec.dump_compact)
+        elif obj is True:
+            buf.append(codec.TRUE)
+        elif obj is False:
+            buf.append(codec.FALSE)
+        elif obj is None:
+            buf.append(codec.NULL)
+        elif isinstance(obj, int):
+            if 0 <= obj < 32:
+                buf.append(obj)
+            else:
+                n = -obj if obj < 0 else obj
+                width = (n.bit_length() + 7) // 8
+                if width > 255:
+                    buf.append(codec.INT)
+                    buf.extend(str(obj).encode('ascii'))
+                    buf.append(codec.END)
+                else:
+                    buf.append(codec.NEG_INT if obj < 0 else codec.POS_INT)
+                    buf.append(width)
+                    buf.extend(n.to_bytes(width, 'big'))
+        elif isinstance(obj, float):
+            buf.append(codec.DOUBLE)
+            buf.extend(struct.pack('>d', obj))
+        elif isinstance(obj, (bytes,bytearray,memoryview)):
+            compressor = getattr(schema, 'compressor', None)
+            packed = compressor.compress(obj) if compressor else None
+            if packed is not None:
+                buf.append(codec.ZIPPED)
+                buf.append(compressor.byte)
+                codec.varint(len(obj), buf)
+                codec.varint(len(packed), buf)
+                buf.extend(packed)
+            else:
+                buf.append(codec.BLOB)
+                codec.varint(len(obj), buf)
+                buf.extend(obj)
+        elif isinstance(obj, (str)):
+            obj = obj.encode('utf-8')
+            buf.append(codec.TEXT)
+            codec.varint(len(obj), buf)
+            buf.extend(obj)
+        elif isinstance(obj, (list, tuple)):
+            buf.append(codec.ARRAY)
+            codec.varint(len(obj), buf)
+            for x in obj:
+                codec.dump_compact(x, buf, schema)
+        elif isinstance(obj, (dict)):
+            buf.append(codec.TABLE)
+            codec.varint(len(obj), buf)
+            for k,v in obj.items():
+                codec.dump_compact(k, buf, schema)
+                codec.dump_compact(v, buf, schema)
+        elif obj.__class__ in codec.tags:
+            tag = codec.tags[obj.__class__].encode('ascii')
+            buf.append(codec.OBJECT)
+            codec.varint(len(tag), buf)
+            buf.extend(tag)
+            codec.dump_compact(codec.records[obj.__class__](obj), buf, schema)
+        else:
+            raise Exception('bad obj {!r}'.format(obj))
+        return buf
+
+    class Schema(dict):
+        """the classes a connection has sent so far, and how it compresses bytes"""
+        compressor = None
+
+    class Compressor:
+        """
+            compresses large bytes values for one end of a connection
+
+            values under MIN_SIZE are sent as they are, and when a value
+            doesn't shrink by enough, the next few are sent as they are 
+            too, backing off further each time, so incompressible data 
+            costs little more than a failed attempt now and then
+        """
+        MIN_SIZE = 4096
+        RATIO = 0.9
+        BACKOFF = 4
+        MAX_BACKOFF = 256
+
+        def __init__(self, method, level=1):
+            self.method = method
+            self.byte, self.fn, _ = codec.methods[method]
+            self.level = level
+            self.skip = 0
+            self.backoff = self.BACKOFF
+            self.raw = self.sent = 0 # bytes given, and bytes sent for them
+
+        def compress(self, data):
+            if len(data) < self.MIN_SIZE:
+                return None
+            self.raw += len(data)
+            if self.skip:
+                self.skip -= 1
+                self.sent += len(data)
+                return None
+            packed = self.fn(data, self.level)
+            if len(packed) > len(data) * self.RATIO:
+                self.skip = self.backoff
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+                self.sent += len(data)
+                return None
+            self.backoff = self.BACKOFF
+            self.sent += len(packed)
+            return packed
+
     def register():
+        """
+            a class decorator, for objects that can be sent. the fields sent 
+            are the arguments to __init__, read back from attributes of the
+            same name, which the class should list in __slots__
+        """
         def decorator(cls):
             name = cls.__name__
             codec.classes[name] = cls
             codec.tags[cls] = name
+            params = inspect.signature(cls).parameters.values()
+            names = [p.name for p in params]
+            defaults = {p.name: p.default for p in params if p.default is not p.empty}
+            codec.fields[cls] = names
+            codec.defaults[cls] = defaults
+            codec.records[cls], codec.structs[cls], codec.builders[cls] = codec.generate(cls, names, defaults)
             return cls
         return decorator
 
+    def generate(cls, names, defaults):
+        """
+            builds the functions used to send and receive one class:
+
+            record(obj) returns a dict of the fields not left at their default
+            struct(obj, buf, schema, dump) writes each field value in order
+            build(values) creates an object from a list of field values
+        """
+        source = ["def record(obj):", "    out = {}"]
+        for name in names:
+            if name in defaults:
+                source.append("    if obj.{0} is not defaults[{0!r}]: out[{0!r}] = obj.{0}".format(name))
+            else:
+                source.append("    out[{0!r}] = obj.{0}".format(name))
+        source.append("    return out")
+
+        source.append("def struct(obj, buf, schema, dump):")
+        for name in names:
+            source.append("    value = obj.{}".format(name))
+            source.append("    if value is None: buf.append(NULL)")
+            source.append("    elif value.__class__ is int and 0 <= value < 32: buf.append(value)")
+            source.append("    else: dump(value, buf, schema)")
+        source.append("    return buf")
+
+        source.append("def build(values):")
+        source.append("    return cls({})".format(", ".join("values[{}]".format(i) for i in range(len(names)))))
+
+        namespace = {'cls': cls, 'defaults': defaults, 'NULL': codec.NULL}
+        exec("\n".join(source), namespace)
+        return namespace['record'], namespace['struct'], namespace['build']
+
 class wire:
     @codec.register()
     class Session:
-        def __init__(self, idx, value, file_handles):
+        __slots__ = ('idx', 'value', 'file_handles', 'credits')
+
+        def __init__(self, idx, value, file_handles, credits=None):
             self.idx = idx
             self.value = value
             self.file_handles = file_handles
+            self.credits = credits
 
     class BadArg(Exception):
         def action(self, path):
@@ -526,13 +1122,42 @@ class wire:
 
     @codec.register()
     class FileHandle:
-        def __init__(self, name, mode, buf=None):
+        __slots__ = ('name', 'mode', 'buf', 'digest')
+
+        def __init__(self, name, mode, buf=None, digest=None):
             self.name = name
             self.mode = mode
             self.buf = buf
+            self.digest = digest # sha256 of an infile, when the server may have it already
+
+    @codec.register()
+    class Signature:
+        """
+            the blocks of an older copy of an infile, so the client can send
+            the new one as a delta: a list of block numbers and literal bytes
+
+            weak is the adler32 of each block, and strong has eight bytes of
+            blake2b for each, one after the other
+        """
+        __slots__ = ('block', 'weak', 'strong')
+
+        def __init__(self, block, weak, strong):
+            self.block = block
+            self.weak = weak
+            self.strong = strong
+
+    @codec.register()
+    class Ran:
+        """sent back by a session's child after its last result, with how long the function took"""
+        __slots__ = ('seconds',)
+
+        def __init__(self, seconds):
+            self.seconds = seconds
 
     @codec.register()
     class Argspec:
+        __slots__ = ('switches', 'flags', 'lists', 'positional', 'optional', 'tail', 'argtypes', 'descriptions', 'compiled')
+
         def __init__(self, switches, flags, lists, positional, optional, tail, argtypes, descriptions):
             self.switches = switches
             self.flags = flags
@@ -542,9 +1167,17 @@ class wire:
             self.tail = tail
             self.argtypes = argtypes
             self.descriptions = descriptions
+            self.compiled = None # not sent, but built by matcher() when first needed
+
+        def matcher(self):
+            if self.compiled is None:
+                self.compiled = ArgMatcher(self)
+            return self.compiled
 
     @codec.register()
     class Request:
+        __slots__ = ('action', 'path', 'argv')
+
         def __init__(self, action, path, argv):
             self.action = action
             self.path = path
@@ -552,13 +1185,43 @@ class wire:
 
     @codec.register()
     class Response:
+        __slots__ = ('exit_code', 'value', 'file_handles')
+
         def __init__(self, exit_code, value, file_handles=()):
             self.exit_code = exit_code
             self.value = value
             self.file_handles = file_handles
             
+    @codec.register()
+    class Frame:
+        """a request or response, tagged so replies can arrive out of order"""
+        __slots__ = ('tag', 'body')
+
+        def __init__(self, tag, body):
+            self.tag = tag
+            self.body = body
+
+    @codec.register()
+    class Traced:
+        """a response, with the spans the server recorded since the last one, for --trace"""
+        __slots__ = ('body', 'spans')
+
+        def __init__(self, body, spans):
+            self.body = body
+            self.spans = spans
+
+    @codec.register()
+    class Hello:
+        __slots__ = ('options', 'command')
+
+        def __init__(self, options, command):
+            self.options = options
+            self.command = command
+
     @codec.register()
     class Command:
+        __slots__ = ('prefix', 'name', 'subcommands', 'short', 'long', 'argspec')
+
         def __init__(self, prefix, name, subcommands, short, long, argspec):
             self.prefix = prefix
             self.name = name
@@ -567,16 +1230,49 @@ class wire:
             self.argspec = argspec
 
         def version(self):
-            return "<None>"
+            """a hash of the whole tree, so clients can tell when a cached copy is stale"""
+            return hashlib.sha256(codec.dump(self, bytearray())).hexdigest()
+
+        def render(self, path=None, depth=None):
+            """the same tree as cli.Command.render would give, from a copy of it"""
+            if depth is None:
+                return self
+            if depth < 0 or self.subcommands is None:
+                return wire.Command(self.prefix, self.name, None, self.short, None, None)
+            if path and path[0] in self.subcommands:
+                subcommands = {k: v.render(path[1:], depth) if k == path[0] else v.render(None, -1) for k,v in self.subcommands.items()}
+            else:
+                subcommands = {k: v.render(None, depth-1) for k,v in self.subcommands.items()}
+            return wire.Command(self.prefix, self.name, subcommands, self.short, self.long, self.argspec)
+
+        def partial(self):
+            """if any command in the tree is a stub"""
+            return self.subcommands is None or any(cmd.partial() for cmd in self.subcommands.values())
+
+        def stub_along(self, path):
+            """if a command along path, or where it ends, is a stub and needs fetching"""
+            node = self
+            for name in path:
+                if node.subcommands is None or name not in node.subcommands:
+                    break
+                node = node.subcommands[name]
+            return node.subcommands is None
+
+        def graft(self, old):
+            """fill in the stubs of a freshly rendered tree from an older copy, where it has them"""
+            if old is None or old.subcommands is None:
+                return self
+            if self.subcommands is None:
+                return old
+            for name, cmd in self.subcommands.items():
+                self.subcommands[name] = cmd.graft(old.subcommands.get(name))
+            return self
 
         def complete(self, path, text):
             if path and path[0] in self.subcommands:
                 return self.subcommands[path[0]].complete(path[1:], text)
             elif not path:
-                output = []
-                for name in self.subcommands:
-                    if name.startswith(text):
-                        output.append(name)
+                output = [name for name in self.subcommands if name.startswith(text)]
                 if output:
                     return output
 
@@ -593,12 +1289,10 @@ class wire:
             if '=' in prefix:
                 # check to see if it's a completeable type
                 return ()
+            elif not self.argspec:
+                return []
             else:
-                out = []
-                out.extend("--{}".format(x) for x in self.argspec.switches if x.startswith(prefix))
-                out.extend("--{}=".format(x) for x in self.argspec.flags if x.startswith(prefix))
-                out.extend("--{}=".format(x) for x in self.argspec.lists if x.startswith(prefix))
-                return out
+                return self.argspec.matcher().complete(prefix)
                 
             
 
@@ -709,6 +1403,9 @@ class cli:
             self.long = None
             self.argspec = None
             self.nargs = 0
+            self.warmup_fn = None
+            self.warmed = False
+            self.backend = "fork"
 
         # -- builder methods
 
@@ -719,8 +1416,17 @@ class cli:
             self.subcommands[name] = cmd
             return cmd
 
-        def run(self, argspec=None):
-            """A decorator for setting the function to be run"""
+        def run(self, argspec=None, backend="fork"):
+            """
+                A decorator for setting the function to be run
+
+                backend is "fork" to run each call in a child process, or
+                "thread" to run it in the server, on a thread pool
+            """
+
+            if backend not in ("fork", "thread"):
+                raise Exception('bad backend')
+            self.backend = backend
 
             if argspec is not None:
                 self.nargs, self.argspec = parse_argspec(argspec)
@@ -740,14 +1446,44 @@ class cli:
                 return fn
             return decorator
 
+        def warmup(self, fn):
+            """A decorator for a function to run once, before serving any calls"""
+            self.warmup_fn = fn
+            return fn
+
         # -- end of builder methods
 
-        def render(self):
+        def warm(self):
+            """run the warmup functions below here, once"""
+            if self.warmed:
+                return
+            self.warmed = True
+            if self.warmup_fn:
+                self.warmup_fn()
+            for cmd in self.subcommands.values():
+                cmd.warm()
+
+        def render(self, path=None, depth=None):
+            """
+                the tree of commands from here, to send to a client
+
+                given a depth, only the commands along path, and depth levels
+                below where it ends, are filled in. the rest are stubs, with
+                no subcommands, only a name and short description
+            """
+            if depth is not None and depth < 0:
+                return wire.Command(name=self.name, prefix=self.prefix, subcommands=None, short=self.short, long=None, argspec=None)
             long =self.run_fn.__doc__ if (not self.long and self.run_fn) else self.long
+            if depth is None:
+                subcommands = {k: v.render() for k,v in self.subcommands.items()}
+            elif path and path[0] in self.subcommands:
+                subcommands = {k: v.render(path[1:], depth) if k == path[0] else v.render(None, -1) for k,v in self.subcommands.items()}
+            else:
+                subcommands = {k: v.render(None, depth-1) for k,v in self.subcommands.items()}
             return wire.Command(
                 name = self.name,
                 prefix = self.prefix,
-                subcommands = {k: v.render() for k,v in self.subcommands.items()},
+                subcommands = subcommands,
                 short = self.short,
                 long = long,
                 argspec = self.argspec, 
@@ -756,6 +1492,7 @@ class cli:
 
 
         def call(self, path, argv):
+            self.warm() # when not warmed before serving, as for a local run
             if path and path[0] == 'help':
                 return self.help(path[1:])
             elif path and path[0] in self.subcommands:
@@ -779,7 +1516,10 @@ class cli:
                 cli.main(self)
 
         def spawn(self, argv):
-            session = cli.Session(self.run_fn, argv)
+            if self.backend == "thread":
+                session = cli.ThreadSession(self.run_fn, argv)
+            else:
+                session = cli.Session(self.run_fn, argv)
             session.fork()
             return session
         
@@ -803,73 +1543,572 @@ class cli:
 
 
 
-        def obj_reader(self):
-            os.close(self.w)
+        def obj_reader(self, close_other=True):
+            if close_other: os.close(self.w)
             os.set_blocking(self.r, False)
-            pipe = os.fdopen(self.r, 'rb')
-            def reader():
-                while True:
-                    line = pipe.readline().decode('ascii').strip()
-                    if not line:  # blank line means it's probably over
-                        yield
-                    else:
-                        size = int(line)
-                        buf = pipe.read(size)
-                        if size < 0: break
-                        obj, _ = codec.parse(buf, 0)
-                        yield obj
-                pipe.close()
-            return reader()
+            return cli.FrameReader(self.r)
 
 
-        def obj_writer(self):
-            os.close(self.r)
+        def obj_writer(self, close_other=True):
+            if close_other: os.close(self.r)
             pipe = os.fdopen(self.w, 'wb')
 
+            schema = {}
             def writer(obj=None, end=False):
                 if end:
                     pipe.write(b"-1\n")
                     pipe.close()
                 else:
-                    buf = codec.dump(obj, bytearray())
+                    buf = codec.dump_compact(obj, bytearray(), schema)
                     pipe.write(b"%d\n" % (len(buf)))
                     pipe.write(buf)
                     pipe.flush()
 
+            writer.file = pipe
             return writer
 
+    class FrameReader:
+        """
+            reads the frames written by obj_writer from a non-blocking fd
+
+            next() returns EMPTY when no whole frame has arrived yet, and
+            raises StopIteration once the writer is finished
+        """
+        EMPTY = object() # rather than None, which a command may yield
+
+        def __init__(self, fd):
+            self.fd = fd
+            self.decoder = codec.Decoder()
+            self.frames = collections.deque()
+            self.eof = False
+            self.done = False
+            self.received = 0 # bytes read, so callers can budget how much they take
+
+        def fileno(self):
+            return self.fd
+
+        def fill(self):
+            while not self.eof:
+                try:
+                    data = os.read(self.fd, 65536)
+                except BlockingIOError:
+                    break
+                if data:
+                    self.received += len(data)
+                    self.frames.extend(self.decoder.feed(data))
+                else:
+                    self.eof = True
+
+        def ready(self):
+            if not self.done:
+                self.fill()
+            return bool(self.frames) or self.done or self.eof or self.decoder.closed
+
+        def close(self):
+            if not self.done:
+                self.done = True
+                os.close(self.fd)
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            if not self.frames and not self.done:
+                self.fill()
+            if self.frames:
+                return self.frames.popleft()
+            if self.done or self.eof or self.decoder.closed:
+                self.close()
+                raise StopIteration()
+            return self.EMPTY
+
+
+    class InputStream:
+        """
+            the server's end of a pipe feeding an infile, or stdin, to the child
+
+            chunks from the client are buffered until the pipe has room.
+            the client is given credit for a window of several chunks, and
+            more as soon as a chunk's worth has been written, so the rest of
+            the window keeps the pipe full while the next chunks are on their
+            way, and at most a window is held per file
+        """
+        CHUNK = 256 * 1024
+        WINDOW = 16 * CHUNK # enough to cover a round trip over ssh, at a good clip
+
+        def __init__(self, fd, sink=None):
+            self.fd = fd
+            os.set_blocking(fd, False)
+            self.buf = bytearray()
+            self.eof = False
+            self.closed = False
+            self.registered = False
+            self.sink = sink # a FileCache.Writer keeping a copy, if any
+
+        def fileno(self):
+            return self.fd
+
+        def credit(self):
+            if self.closed:
+                return -1 # stop sending, the child has stopped reading
+            if self.eof:
+                return 0
+            room = self.WINDOW - len(self.buf)
+            return room if room >= self.CHUNK else 0
+
+        def feed(self, chunk):
+            if chunk == b'':
+                self.eof = True
+            else:
+                self.buf.extend(chunk)
+                if self.sink:
+                    self.sink.write(chunk)
+            self.flush()
+
+        def flush(self):
+            while self.buf and not self.closed:
+                try:
+                    size = os.write(self.fd, self.buf)
+                except BlockingIOError:
+                    break
+                except BrokenPipeError:
+                    self.buf.clear()
+                    self.close()
+                    break
+                del self.buf[:size]
+            if self.eof and not self.buf:
+                self.close()
+
+        def close(self):
+            if self.sink:
+                self.sink.close(complete=self.eof)
+                self.sink = None
+            if not self.closed:
+                self.closed = True
+                os.close(self.fd)
+
+        def forget(self):
+            """close a forked child's copy, leaving any copy being cached to the parent"""
+            self.sink = None
+            if not self.closed:
+                self.closed = True
+                os.close(self.fd)
+
+        def offer(self, deltas):
+            return self.credit()
+
+    class DeltaStream(InputStream):
+        """
+            an InputStream for an infile the server has an older copy of
+
+            when the client can take one, it is sent a signature of the old
+            copy in place of its first credit, and then sends deltas against
+            it, which are expanded here before being passed on
+        """
+        MIN_BLOCK = 2048
+        MAX_BLOCK = 1 << 16
+
+        def __init__(self, fd, sink, base):
+            cli.InputStream.__init__(self, fd, sink)
+            self.base = base
+            self.block = None
+            self.blocks = 0 # in the signature sent, so deltas can only refer to those
+            self.offered = False
+
+        def sign(self):
+            size = os.fstat(self.base.fileno()).st_size
+            self.block = max(self.MIN_BLOCK, min(self.MAX_BLOCK, 1 << (size.bit_length() // 2)))
+            weak, strong = [], bytearray()
+            while True:
+                block = self.base.read(self.block)
+                if len(block) < self.block:
+                    break # the tail is sent as it is
+                weak.append(zlib.adler32(block))
+                strong.extend(hashlib.blake2b(block, digest_size=8).digest())
+            self.blocks = len(weak)
+            return wire.Signature(self.block, weak, bytes(strong))
+
+        def offer(self, deltas):
+            if deltas and not self.offered and not self.closed:
+                self.offered = True
+                return self.sign()
+            return self.credit()
+
+        def feed(self, chunk):
+            if isinstance(chunk, list) and self.block:
+                data = bytearray()
+                for op in chunk:
+                    if isinstance(op, int):
+                        if not 0 <= op < self.blocks:
+                            raise ValueError('bad delta, no block {}'.format(op))
+                        self.base.seek(op * self.block)
+                        data.extend(self.base.read(self.block))
+                    elif isinstance(op, (bytes, bytearray, memoryview)):
+                        data.extend(op)
+                    else:
+                        raise ValueError('bad delta, {!r}'.format(op))
+                chunk = bytes(data) if data else None
+                if chunk is None:
+                    return
+            cli.InputStream.feed(self, chunk)
+
+        def close(self):
+            cli.InputStream.close(self)
+            self.base.close()
+
+        def forget(self):
+            cli.InputStream.forget(self)
+            self.base.close()
+
+    class DeltaReader:
+        """
+            the client's end of a DeltaStream, reading an infile as a list
+            of the server's block numbers, and literal bytes for the rest
+
+            blocks are looked for at every offset, rolling the checksum
+            along one byte at a time, but after ROLL_LIMIT bytes without a 
+            match, only at block boundaries, as rolling is slow in python
+        """
+        ROLL_LIMIT = 256 * 1024
+
+        def __init__(self, fh, signature):
+            self.fh = fh
+            self.block = signature.block
+            self.blocks = {}
+            strongs = bytes(signature.strong)
+            for idx, weak in enumerate(signature.weak):
+                self.blocks.setdefault(weak, {}).setdefault(strongs[idx*8:idx*8+8], idx)
+            self.buf = bytearray()
+            self.eof = False
+            self.unmatched = 0 # bytes since the last block found
+
+        @property
+        def closed(self):
+            return self.fh.closed
+
+        def close(self):
+            self.fh.close()
+
+        def find(self, weak, window):
+            strongs = self.blocks.get(weak)
+            if strongs:
+                return strongs.get(hashlib.blake2b(window, digest_size=8).digest())
+
+        def read(self, size):
+            """the delta for roughly the next size bytes, or b'' at the end"""
+            block = self.block
+            while len(self.buf) < size + block and not self.eof:
+                data = self.fh.read(max(size + block - len(self.buf), 1 << 20))
+                if not data:
+                    self.eof = True
+                self.buf.extend(data)
+            buf = memoryview(self.buf)
+            limit = len(buf)
+            ops = []
+            start = pos = 0
+            unmatched = self.unmatched
+            weak = None
+            while pos < size and pos + block <= limit:
+                if weak is None:
+                    weak = zlib.adler32(buf[pos:pos+block])
+                idx = self.find(weak, buf[pos:pos+block])
+                if idx is not None:
+                    if start < pos:
+                        ops.append(bytes(buf[start:pos]))
+                    ops.append(idx)
+                    pos = start = pos + block
+                    unmatched = 0
+                    weak = None
+                elif unmatched + pos - start >= self.ROLL_LIMIT:
+                    pos += block
+                    weak = None
+                elif pos + block < limit:
+                    out, into = buf[pos], buf[pos+block]
+                    a = ((weak & 0xffff) - out + into) % 65521
+                    b = ((weak >> 16) - block * out + a - 1) % 65521
+                    weak = (b << 16) | a
+                    pos += 1
+                else:
+                    pos = limit # the last window of the file, and it didn't match
+            if self.eof and pos + block > limit:
+                pos = limit
+            if start < pos:
+                ops.append(bytes(buf[start:pos]))
+            self.unmatched = unmatched + pos - start
+            buf.release()
+            del self.buf[:pos]
+            return ops or b''
+
+    class CachedInput:
+        """stands in for the InputStream of an infile the server already had"""
+        fd = None
+        closed = True
+        registered = False
+        buf = b""
+
+        def credit(self):
+            return -1 # so the client closes its copy, and sends nothing
+
+        def offer(self, deltas):
+            return -1
+
+        def feed(self, chunk):
+            pass
+
+        def flush(self):
+            pass
+
+        def close(self):
+            pass
+
+        def forget(self):
+            pass
+
+    class FileCache:
+        """
+            infile contents kept by the server, named by their sha256, so a
+            client needn't send a file the server has already been sent
+
+            hits are touched, and the least recently used files go once the
+            total is over MAX_SIZE
+
+            the last digest seen for each file name is kept too, so a changed
+            file can be sent as a delta against the copy the server has.
+            names and contents are kept apart for each client, the user on
+            the other end of a unix socket, or the connection for http, so
+            one client can't read another's file by knowing its digest, or
+            ask for its signature, or build a delta from it
+        """
+        MAX_SIZE = 1 << 30
+        shared = None
+        client = contextvars.ContextVar('client', default=None) # set by servers shared between clients
+
+        def __init__(self, path, max_size=None):
+            self.path = path
+            self.max_size = self.MAX_SIZE if max_size is None else max_size
+            os.makedirs(path, exist_ok=True)
+
+        @staticmethod
+        def default():
+            if cli.FileCache.shared is None:
+                cli.FileCache.shared = cli.FileCache(os.path.join(cli.cache_dir(), 'infiles'))
+            return cli.FileCache.shared
+
+        @staticmethod
+        def scoped(name):
+            """the name a client's file is remembered under"""
+            client = cli.FileCache.client.get()
+            return name if client is None else "{}\0{}".format(client, name)
+
+        @staticmethod
+        def key(digest):
+            """the name a client's copy of a file is cached under"""
+            client = cli.FileCache.client.get()
+            if client is None:
+                return digest
+            return hashlib.sha256("{}\0{}".format(client, digest).encode('utf-8', 'surrogateescape')).hexdigest()
+
+        @staticmethod
+        def valid(digest):
+            return isinstance(digest, str) and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+        def lookup(self, digest):
+            path = os.path.join(self.path, cli.FileCache.key(digest))
+            try:
+                fh = open(path, 'rb')
+            except FileNotFoundError:
+                return None
+            os.utime(path)
+            return fh
+
+        def writer(self, digest, name=None):
+            try:
+                return cli.FileCache.Writer(self, digest, name)
+            except OSError:
+                return None # a cache we can't write is just a slower cache
+
+        def name_path(self, name):
+            return os.path.join(self.path, 'names', hashlib.sha256(name.encode('utf-8', 'surrogateescape')).hexdigest()[:32])
+
+        def remember(self, name, digest):
+            try:
+                os.makedirs(os.path.join(self.path, 'names'), exist_ok=True)
+                path = self.name_path(name)
+                tmp = "{}.{}".format(path, os.getpid())
+                with open(tmp, 'w') as fh:
+                    fh.write(digest)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+        def base(self, name):
+            """the last copy of a file with this name, if it is still cached"""
+            try:
+                with open(self.name_path(name)) as fh:
+                    digest = fh.read()
+            except OSError:
+                return None
+            return self.lookup(digest) if self.valid(digest) else None
+
+        def evict(self):
+            entries = []
+            for name in os.listdir(self.path):
+                if self.valid(name):
+                    try:
+                        st = os.stat(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, name))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        class Writer:
+            """copies an infile as it arrives, and adds it to the cache if all of it does"""
+            def __init__(self, cache, digest, name=None):
+                self.cache = cache
+                self.digest = digest
+                self.key = cli.FileCache.key(digest)
+                self.name = name
+                self.path = os.path.join(cache.path, ".{}.{}.{}".format(self.key, os.getpid(), id(self)))
+                self.fh = open(self.path, 'wb', buffering=0) # unbuffered, so forks have nothing to flush
+                self.hash = hashlib.sha256()
+
+            def write(self, chunk):
+                if self.fh:
+                    try:
+                        self.fh.write(chunk)
+                        self.hash.update(chunk)
+                    except OSError:
+                        self.close(complete=False)
+
+            def close(self, complete):
+                if not self.fh:
+                    return
+                self.fh.close()
+                self.fh = None
+                if complete and self.hash.hexdigest() == self.digest:
+                    os.replace(self.path, os.path.join(self.cache.path, self.key))
+                    if self.name:
+                        self.cache.remember(self.name, self.digest)
+                    self.cache.evict()
+                else:
+                    os.unlink(self.path)
 
     class Session():
+        LONG_POLL = 0.5 # seconds a poll waits for output before returning empty
+        BATCH_BYTES = 1 << 20 # roughly how much output and results one batched poll gathers
+        BATCH_TIME = 0.05 # and for how many seconds, at most
+        running = set() # forked and not yet reaped, so children can close their pipes
+        deltas = False # if the client agreed to send infiles as deltas
+        batch = False # if the client agreed to take a list of results with each poll
+        stream_stdin = False # if the client agreed to send stdin as credit allows
+        stdin_offered = 0 # the stdin credit last given to the client
+        stdin_waiting = True # if the client may have stdin to send, as far as we know
+        ran = None # how long the function took, once the child has said
+        trace = None # the connection's cli.Trace, if the client asked for one
+
         def __init__(self, run_fn, argv):
             self.run_fn = run_fn
             self.argv = argv
             self.count = 0
 
-        def fork(self):
+        def open_args(self):
+            """open pipes for any file arguments, returning the arguments, the child's ends, and its outfiles"""
+            self.started = time.perf_counter()
             args = {}
             file_handles = {}
+            infiles = {}
+            child_ends = [] # files only the child should keep open
+            outfiles = [] # and the ones it must flush before exiting
+
+            def open_fh(name, value):
+                sink = base = None
+                if isinstance(value, wire.FileHandle) and value.mode == "read" and value.buf is None and cli.FileCache.valid(value.digest):
+                    cache = cli.FileCache.default()
+                    fh = cache.lookup(value.digest)
+                    scoped = cli.FileCache.scoped(value.name)
+                    if fh:
+                        cache.remember(scoped, value.digest)
+                        value, mode = fh, "cached"
+                    else:
+                        sink = cache.writer(value.digest, scoped)
+                        base = cache.base(scoped)
+                        value, mode = self.create_fh(value)
+                else:
+                    value, mode = self.create_fh(value)
+                if mode == "write":
+                    if name not in file_handles: file_handles[name] = []
+                    file_handles[name].append(value.byte_reader(close_other=False))
+                    fh = value.byte_writer(close_other=False)
+                    outfiles.append(fh)
+                    return fh
+                elif mode == "read":
+                    if name not in infiles: infiles[name] = []
+                    if base:
+                        infiles[name].append(cli.DeltaStream(value.w, sink, base))
+                    else:
+                        infiles[name].append(cli.InputStream(value.w, sink))
+                    fh = os.fdopen(value.r, 'rb')
+                    child_ends.append(fh)
+                    return fh
+                elif mode == "cached":
+                    if name not in infiles: infiles[name] = []
+                    infiles[name].append(cli.CachedInput())
+                    child_ends.append(value)
+                return value
+
             for name, values in self.argv.items():
                 if isinstance(values, list):
-                    out = []
-                    for value in values:
-                        value, pipe = self.create_fh(value)
-                        if pipe:
-                            if name not in file_handles: file_handles[name] = []
-                            file_handles[name].append(value.byte_reader(close_other=False))
-                            out.append(value.byte_writer(close_other=False))
-                        else:
-                            out.append(value)
-                    args[name] = out
-                
+                    args[name] = [open_fh(name, value) for value in values]
                 else:
-                    value, pipe = self.create_fh(values)
-                    if pipe:
-                        file_handles[name] = [value.byte_reader(close_other=False)]
-                        args[name] = value.byte_writer(close_other=False)
-                    else:
-                        args[name] = value
+                    args[name] = open_fh(name, values)
 
             self.file_handles = file_handles
+            self.infiles = infiles
+            self.stdin = None
+            return args, child_ends, outfiles
+
+        def run(self, args, writer, outfiles):
+            """call the function and send back what it returns, from the child's side"""
+            start = time.perf_counter()
+            try:
+                result = self.run_fn(**args)
+                sys.stderr.flush()
+                sys.stdout.flush()
+                if not isinstance(result, types.GeneratorType):
+                    result = [result]
+                for r in result:
+                    writer(r)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                for fh in outfiles:
+                    if not fh.closed:
+                        fh.close()
+                writer(wire.Ran(time.perf_counter() - start))
+                writer(end=True)
+
+        def watch(self):
+            """set up the selector over the parent's ends, once the child is running"""
+            self.forked = time.perf_counter()
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.console, selectors.EVENT_READ)
+            self.selector.register(self.reader, selectors.EVENT_READ)
+            for fhs in self.file_handles.values():
+                for fh in fhs:
+                    self.selector.register(fh, selectors.EVENT_READ)
+            cli.Session.running.add(self)
+
+        def fork(self):
+            args, child_ends, outfiles = self.open_args()
 
             result_pipe = cli.Pipe()
             console_pipe = cli.Pipe()
@@ -877,6 +2116,11 @@ class cli:
 
             pid = os.fork()
             if pid == 0:
+                for stream in self.streams():
+                    stream.forget()
+                for other in cli.Session.running:
+                    other.close_parent_ends() # or their children never see eof
+                cli.ThreadSession.restore() # while a thread session runs, sys.stdin and co. are stand-ins
                 console = console_pipe.byte_writer()
                 stdin = stdin_pipe.byte_reader()
                 os.set_blocking(stdin.fileno(), True)
@@ -885,48 +2129,124 @@ class cli:
                 os.dup2(console.fileno(), sys.stderr.fileno())
                 writer = result_pipe.obj_writer()
                 try:
-                    result = self.run_fn(**args)
-                    sys.stderr.flush()
-                    sys.stdout.flush()
-                    if not isinstance(result, types.GeneratorType):
-                        result = [result]
-                    for r in result:
-                        writer(r)
+                    self.run(args, writer, outfiles)
                 finally:
-                    writer(end=True)
                     sys.stdout.close()
                     sys.stderr.close()
                     console.close()
-                sys.exit(0)
+                    os._exit(0) # never unwind back into the server, or its event loop
             else:
+                for fh in child_ends:
+                    fh.close()
                 self.pid = pid
                 self.console = console_pipe.byte_reader()
                 self.reader = result_pipe.obj_reader()
-                self.stdin = stdin_pipe.byte_writer()
+                os.close(stdin_pipe.r)
+                self.stdin = cli.InputStream(stdin_pipe.w)
+                self.watch()
+
+        def reap(self):
+            os.waitpid(self.pid, 0)
+
+        def close_parent_ends(self):
+            self.selector.close()
+            self.console.close()
+            self.reader.close()
+            for stream in self.streams():
+                stream.forget()
+            for fhs in self.file_handles.values():
+                for fh in fhs:
+                    fh.close()
+
+        def streams(self):
+            streams = [s for streams in self.infiles.values() for s in streams]
+            if self.stdin:
+                streams.append(self.stdin)
+            return streams
+
+        def credits(self):
+            """how many bytes of each infile and stdin the client may send next, or a signature to send a delta against"""
+            credits = {name: [s.offer(self.deltas) for s in streams] for name, streams in self.infiles.items()}
+            if self.stream_stdin:
+                credits['stdin'] = self.stdin_offered = self.stdin.credit()
+            return credits or None
+
+        def flush_streams(self):
+            for stream in self.streams():
+                stream.flush()
+                if stream.buf and not stream.closed:
+                    if not stream.registered:
+                        self.selector.register(stream, selectors.EVENT_WRITE)
+                        stream.registered = True
+                elif stream.registered:
+                    self.selector.unregister(stream)
+                    stream.registered = False
+
+        def wait(self, timeout):
+            """block until there is output, a result, room for an infile or stdin chunk, or the child has exited"""
+            self.flush_streams()
+            # stdin only counts while the client is sending it, or an idle terminal would busy poll
+            streams = [s for s in self.streams() if s is not self.stdin or self.stdin_waiting]
+            if self.reader.ready() or any(s.credit() > 0 for s in streams):
+                return True
+            events = self.selector.select(timeout)
+            self.flush_streams()
+            return bool(events)
 
         def create_fh(self, value):
             if isinstance(value, wire.FileHandle):
                 if value.mode == "read":
+                    if value.buf is None: # sent in chunks while the command runs
+                        return cli.Pipe(), "read"
                     buf = io.BytesIO()
                     buf.write(value.buf)
                     buf.seek(0)
-                    return buf, False
+                    return buf, None
                 elif value.mode == "write":
-                    return cli.Pipe(), True
-            return value, False
+                    return cli.Pipe(), "write"
+            return value, None
 
         def close(self):
-            pass
-
-        def poll(self, client_file_handles=()):
-            if self.stdin and 'stdin' in client_file_handles:
-                buf = client_file_handles['stdin']
-                if buf == b'':
-                    self.stdin.close()
-                    self.stdin = None
-                elif buf is not None:
-                    self.stdin.write(buf)
-                    self.stdin.flush()
+            """stop a session the client has walked away from, and close its pipes"""
+            if self not in cli.Session.running:
+                return
+            self.stop()
+            cli.Session.running.discard(self)
+            for stream in self.streams():
+                stream.close() # and drop any partial copy being cached
+            cli.Session.close_parent_ends(self)
+
+        def stop(self):
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.reap()
+
+        def poll(self, client_file_handles=(), timeout=0):
+            self.feed(client_file_handles)
+            if timeout:
+                self.wait(timeout)
+            return self.collect()
+
+        def feed(self, client_file_handles):
+            """pass on stdin and infile chunks sent by the client"""
+            buf = client_file_handles.get('stdin') if client_file_handles else None
+            if buf is not None:
+                self.stdin_waiting = True
+                if not self.stdin.closed:
+                    self.stdin.feed(buf)
+            elif self.stdin_offered or not self.stream_stdin:
+                self.stdin_waiting = False # it had room for some, and sent none
+            for name, streams in self.infiles.items():
+                chunks = client_file_handles.get(name) if client_file_handles else None
+                if chunks:
+                    for stream, chunk in zip(streams, chunks):
+                        if chunk is not None and not stream.closed:
+                            stream.feed(chunk)
+
+        def read_output(self, final=False):
+            """whatever the child has written to its console and outfiles so far"""
             output_fhs = {}
             out = self.console.read()
             if out:
@@ -935,37 +2255,201 @@ class cli:
                 output = []
                 for fh in fhs:
                     output.append(fh.read())
-                if any(output):
+                if final or any(output):
                     output_fhs[name] = output
+            return output_fhs
 
+        def collect(self):
+            """gather any output, the next result, or the final response"""
+            output_fhs = self.read_output()
+            if self.batch:
+                return self.collect_batch(output_fhs)
             if output_fhs:
-                return wire.Session(self, None, output_fhs)
+                return wire.Session(self, None, output_fhs, self.credits())
             try:
-                value = next(self.reader)
-                return wire.Session(self, value, {})
+                value = self.next_value()
+                return wire.Session(self, None if value is cli.FrameReader.EMPTY else value, {}, self.credits())
             except (GeneratorExit, StopIteration):
-                os.wait()
-                output_fhs = {}
-                out = self.console.read()
-                if out:
-                    output_fhs['console'] = out
-                for name, fhs in self.file_handles.items():
-                    output_fhs[name] = []
-                    for fh in fhs:
-                        output_fhs[name].append(fh.read())
-
-                return wire.Response(0, None, file_handles=output_fhs)
+                return self.finish()
+
+        def collect_batch(self, output_fhs):
+            """gather the output along with every result ready so far, as a list, within the batch budget"""
+            deadline = time.monotonic() + self.BATCH_TIME
+            size = 0
+            for output in output_fhs.values():
+                for buf in (output if isinstance(output, list) else [output]):
+                    size += len(buf) if buf else 0
+            budget = self.reader.received + self.BATCH_BYTES - size
+            values = []
+            while self.reader.received < budget and time.monotonic() < deadline:
+                try:
+                    value = self.next_value()
+                except (GeneratorExit, StopIteration):
+                    if values or output_fhs:
+                        break # the final response can wait for the next poll
+                    return self.finish()
+                if value is cli.FrameReader.EMPTY:
+                    break
+                values.append(value)
+            return wire.Session(self, values or None, output_fhs, self.credits())
+
+        def next_value(self):
+            """the next result, or FrameReader.EMPTY if there isn't one yet, keeping the run time when it arrives"""
+            value = next(self.reader)
+            if isinstance(value, wire.Ran):
+                self.ran = value.seconds
+                value = next(self.reader)
+            return value
+
+        def finish(self):
+            """reap the child, and return the final response with the last of its output"""
+            self.reap()
+            if self.trace and self.ran is not None:
+                self.trace.spans.append((self.trace.process, "run", self.forked, self.ran, {}))
+            cli.Session.running.discard(self)
+            self.selector.close()
+            for stream in self.streams():
+                stream.close()
+            return wire.Response(0, None, file_handles=self.read_output(final=True))
+
+    class ContextStream:
+        """
+            stands in for sys.stdin, stdout, or stderr, and switches to a thread session's own
+
+            special methods are looked up on the type, not the instance, so
+            the ones a stream is used through are passed on explicitly
+        """
+        def __init__(self, name, default):
+            self._name = name
+            self._default = default
+
+        def _stream(self):
+            streams = cli.ThreadSession.stdio.get()
+            return streams[self._name] if streams else self._default
+
+        def __getattr__(self, attr):
+            return getattr(self._stream(), attr)
+
+        def __iter__(self):
+            return iter(self._stream())
+
+        def __next__(self):
+            return next(self._stream())
+
+        def __enter__(self):
+            return self._stream().__enter__()
+
+        def __exit__(self, *args):
+            return self._stream().__exit__(*args)
+
+    class ThreadSession(Session):
+        """
+            a Session run on a thread pool, for commands too cheap to fork for
+
+            the function's stdin, stdout and stderr are swapped in through
+            cli.ContextStream, so each session's output still reaches its
+            own console, and the parent's ends of the pipes work as before.
+            sys.stdin, stdout and stderr are only replaced while thread
+            sessions are running, and forked children get the real ones back
+        """
+        WORKERS = 16
+        pool = None
+        stdio = contextvars.ContextVar('stdio', default=None)
+        lock = threading.Lock()
+        active = 0 # thread sessions running, while the stand-ins are installed
+
+        def install():
+            with cli.ThreadSession.lock:
+                if cli.ThreadSession.active == 0:
+                    for name in ('stdin', 'stdout', 'stderr'):
+                        setattr(sys, name, cli.ContextStream(name, getattr(sys, name)))
+                cli.ThreadSession.active += 1
+
+        def uninstall():
+            with cli.ThreadSession.lock:
+                cli.ThreadSession.active -= 1
+                if cli.ThreadSession.active == 0:
+                    cli.ThreadSession.restore()
+
+        def restore():
+            for name in ('stdin', 'stdout', 'stderr'):
+                stream = getattr(sys, name)
+                if isinstance(stream, cli.ContextStream):
+                    setattr(sys, name, stream._default)
+
+        def fork(self):
+            if cli.ThreadSession.pool is None:
+                cli.ThreadSession.pool = concurrent.futures.ThreadPoolExecutor(self.WORKERS)
+            args, child_ends, outfiles = self.open_args()
+
+            result_pipe = cli.Pipe()
+            console_pipe = cli.Pipe()
+            stdin_pipe = cli.Pipe()
+
+            console = io.TextIOWrapper(os.fdopen(console_pipe.w, 'wb', buffering=0), write_through=True)
+            stdin = io.TextIOWrapper(os.fdopen(stdin_pipe.r, 'rb'))
+            writer = result_pipe.obj_writer(close_other=False)
+            self.thread_ends = child_ends + outfiles + [console, stdin, writer.file]
+
+            self.console = console_pipe.byte_reader(close_other=False)
+            self.reader = result_pipe.obj_reader(close_other=False)
+            self.stdin = cli.InputStream(stdin_pipe.w)
+            self.watch()
+
+            streams = {'stdin': stdin, 'stdout': console, 'stderr': console}
+            context = contextvars.copy_context()
+            cli.ThreadSession.install()
+            self.future = cli.ThreadSession.pool.submit(context.run, self.run_thread, streams, args, writer, outfiles)
+
+        def run_thread(self, streams, args, writer, outfiles):
+            cli.ThreadSession.stdio.set(streams)
+            try:
+                self.run(args, writer, outfiles)
+            finally:
+                for fh in self.thread_ends:
+                    if not fh.closed:
+                        fh.close()
+                cli.ThreadSession.uninstall()
+
+        def close_parent_ends(self):
+            cli.Session.close_parent_ends(self)
+            for fh in self.thread_ends: # a forked child holds these too
+                if not fh.closed:
+                    fh.close()
+
+        def reap(self):
+            self.future.result()
+
+        def stop(self):
+            pass # a thread can't be killed, but stops once its pipes are closed under it
 
     def main(root):
         argv = sys.argv[1:]
         environ = os.environ
         force_local = False # 'COMP_LINE' in environ and 'COMP_POINT' in environ
+        if argv and argv[0].startswith(("--pipe", "--http", "--listen=", "--zygote=")):
+            root.warm()
+
         if argv == ["--pipe"]:
             stdin = os.fdopen(os.dup(sys.stdin.fileno()),'rb')
             stdout = os.fdopen(os.dup(sys.stdout.fileno()),'wb')
             os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
 
             sys.exit(cli.serve_pipe(root, stdin, stdout))
+        elif argv == ["--pipe", "--async"]:
+            stdin = os.fdopen(os.dup(sys.stdin.fileno()),'rb')
+            stdout = os.fdopen(os.dup(sys.stdout.fileno()),'wb')
+            os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+            sys.exit(asyncio.run(cli.serve_pipe_async(root, stdin, stdout)))
+        elif argv and argv[0].startswith("--listen="):
+            sys.exit(asyncio.run(cli.listen_async(root, argv[0].split("=", 1)[1])))
+        elif argv and (argv[0] == "--http" or argv[0].startswith("--http=")):
+            address = argv[0].split("=", 1)[1] if "=" in argv[0] else cli.HTTP_ADDRESS
+            host, port = address.rsplit(":", 1)
+            sys.exit(asyncio.run(cli.serve_http(root, host, int(port))))
+        elif argv and argv[0].startswith("--zygote="):
+            sys.exit(cli.serve_zygote(root, argv[0].split("=", 1)[1]))
         elif argv and argv[0] == "--run":
             sys.exit(cli.run_pipe_client(argv[1:]))
         elif force_local: 
@@ -979,112 +2463,1667 @@ class cli:
                 code = (cli.serve_pipe(root, os.fdopen(input_r, 'rb'), os.fdopen(output_w, 'wb')))
                 sys.exit(code)
             else:
-                cmd = cli.PipeClient(os.fdopen(input_w, 'wb'), os.fdopen(output_r, 'rb'))
+                cmd = cli.PipeClient(os.fdopen(input_w, 'wb'), os.fdopen(output_r, 'rb'), local=True)
                 code = cli.run(cmd, argv, environ)
                 os.write(input_w, b'-1\n')
                 sys.exit(code)
 
     def run_pipe_client(args):
+        trace = None
+        if args and (args[0] == '--trace' or args[0].startswith('--trace=')):
+            trace = cli.Trace()
+            trace_path = args[0].split("=", 1)[1] if "=" in args[0] else None
+            args = args[1:]
+        mux = bool(args) and args[0] == '--mux'
+        if mux:
+            args = args[1:]
+        elif args and args[0] == '--mux-serve':
+            return cli.Mux(args[1]).serve()
+        elif args and args[0] == '--attach':
+            return cli.attach(args[1])
+
         if '--' in args:
             split = args.index('--')
             cmd, args = " ".join(args[:split]), args[split+1:]
         else:
             cmd, args = args[0], args[1:]
 
-        p = subprocess.Popen(
-            cmd,
-            shell = True,
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-        )
-        root = cli.PipeClient(p.stdin, p.stdout)
+        if cmd.startswith("http://"):
+            root = cli.HTTPClient(cmd)
+        else:
+            root = cli.CachedClient(cmd, mux=mux, trace=trace)
+        start = time.perf_counter()
         try:
             ret = cli.run(root, args, os.environ)
         finally:
-            p.stdin.write(b'-1\n') # break out of readline()
-            p.stdin.close()
-            p.wait()
+            root.close()
+            if trace:
+                trace.span("total", start)
+                if trace_path:
+                    trace.save(trace_path)
+                else:
+                    print(trace.summary(), file=sys.stderr)
         return ret
 
+    def cache_dir():
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        return os.path.join(cache_dir, 'textfree86')
+
+    def cache_path(cmd, suffix=""):
+        """where to keep things for a given pipe command"""
+        name = hashlib.sha256(cmd.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(cli.cache_dir(), name + suffix)
+
+    REMOTE_SHELLS = ("ssh",)
+
+    def remote(cmd):
+        """if a pipe command runs on another machine, where compressing large values may be worth it"""
+        try:
+            words = shlex.split(cmd)
+        except ValueError:
+            return False
+        return bool(words) and os.path.basename(words[0]) in cli.REMOTE_SHELLS
+
+    class Trace:
+        """
+            spans of time, recorded for --trace, printed as a summary or
+            saved as chrome trace-event json, for chrome://tracing
+
+            a server sends its spans back with each response, as offsets
+            from when the response was sent, and the client places them
+            from when it arrives, so the two clocks needn't agree
+        """
+        def __init__(self, process="client", send=False):
+            self.process = process
+            self.send = send # if spans go back to the client, with each response
+            self.origin = time.perf_counter()
+            self.spans = [] # (process, name, start, duration, args)
+
+        def span(self, name, start, **args):
+            """record a span from start until now"""
+            self.spans.append((self.process, name, start, time.perf_counter() - start, args))
+
+        def take(self):
+            """the spans so far, as microsecond offsets from now, for sending"""
+            now = time.perf_counter()
+            spans = [[name, int((start - now) * 1e6), int(duration * 1e6), args] for _, name, start, duration, args in self.spans]
+            self.spans = []
+            return spans
+
+        def receive(self, spans):
+            now = time.perf_counter()
+            for name, offset, duration, args in spans:
+                self.spans.append(("server", name, now + offset / 1e6, duration / 1e6, args))
+
+        def events(self):
+            pids = {}
+            events = []
+            for process, name, start, duration, args in self.spans:
+                if process not in pids:
+                    pids[process] = len(pids) + 1
+                    events.append({'name': 'process_name', 'ph': 'M', 'pid': pids[process], 'tid': 1, 'args': {'name': process}})
+                events.append({
+                    'name': name, 'ph': 'X', 'pid': pids[process], 'tid': 1,
+                    'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6, 'args': args,
+                })
+            return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+        def summary(self):
+            totals = {}
+            for process, name, start, duration, args in self.spans:
+                count, total, longest, size = totals.get((process, name), (0, 0, 0, 0))
+                totals[process, name] = (count + 1, total + duration, max(longest, duration), size + args.get('bytes', 0))
+            lines = ["{:<8} {:<8} {:>6} {:>10} {:>10} {:>10}".format("", "", "count", "total ms", "max ms", "bytes")]
+            for (process, name), (count, total, longest, size) in sorted(totals.items()):
+                lines.append("{:<8} {:<8} {:>6} {:>10.2f} {:>10.2f} {:>10}".format(process, name, count, total * 1e3, longest * 1e3, size or ""))
+            return "\n".join(lines)
+
+        def save(self, path):
+            with open(path, 'w') as fh:
+                json.dump(self.events(), fh)
+
+    class Connection:
+        """
+            length-prefixed frames of encoded objects, over a pair of files
+
+            every connection starts out speaking codec version 1, and moves to
+            the compact encoding once both ends have agreed to it in a Hello
+        """
+        def __init__(self, reader, writer):
+            self.reader = reader
+            self.writer = writer
+            self.version = 1
+            self.schema = codec.Schema() # classes sent so far, numbered
+            self.decoder = codec.Decoder()
+            self.frames = collections.deque()
+            self.trace = None # a cli.Trace, timing each frame
+            self.guard = False # refuse the next call, as it was sent against a stale tree
+
+        def agree(self, options):
+            """switch to the encoding agreed in a Hello"""
+            self.version = options.get('codec', 1)
+            if options.get('compress') and self.version > 2:
+                self.schema.compressor = codec.Compressor(options['compress'])
+            if options.get('trace') and self.trace is None:
+                self.trace = cli.Trace("server", send=True)
+
+        def frame(self, obj):
+            start = time.perf_counter()
+            if self.trace and self.trace.send:
+                obj = wire.Traced(obj, self.trace.take())
+            if self.version > 2:
+                buf = codec.dump_compact(obj, bytearray(), self.schema)
+            elif self.version > 1:
+                buf = codec.dump_compact(obj, bytearray())
+            else:
+                buf = codec.dump(obj, bytearray())
+            if self.trace:
+                self.trace.span("encode", start, bytes=len(buf))
+            return b"%d\n" % (len(buf)), buf
+
+        def decode(self, data):
+            start = time.perf_counter()
+            for obj in self.decoder.feed(data):
+                if isinstance(obj, wire.Traced):
+                    if self.trace:
+                        self.trace.receive(obj.spans)
+                    obj = obj.body
+                self.frames.append(obj)
+            if self.trace:
+                self.trace.span("decode", start, bytes=len(data))
+
+        def write(self, obj):
+            size, buf = self.frame(obj)
+            self.writer.write(size)
+            self.writer.write(buf)
+            self.writer.flush()
+
+        def fill(self):
+            """read once from the other end, returning False at the end of the stream"""
+            if self.decoder.closed:
+                return False
+            data = self.reader.read1(65536)
+            if not data:
+                return False
+            self.decode(data)
+            return True
+
+        def read(self):
+            while not self.frames:
+                if not self.fill():
+                    return None
+            return self.frames.popleft()
+
+    class AsyncConnection(Connection):
+        """a Connection over asyncio streams, where write and read are coroutines"""
+
+        async def write(self, obj):
+            size, buf = self.frame(obj)
+            self.writer.write(size)
+            self.writer.write(buf)
+            await self.writer.drain()
+
+        async def read(self):
+            while not self.frames:
+                if self.decoder.closed:
+                    return None
+                data = await self.reader.read(65536)
+                if not data:
+                    return None
+                self.decode(data)
+            return self.frames.popleft()
+
+    def negotiate(offer):
+        """pick the protocol options to use, from the ones a client offers"""
+        options = {}
+        version = min(offer.get('codec', 1), codec.VERSION)
+        if version > 1:
+            options['codec'] = version
+        if offer.get('long_poll'):
+            options['long_poll'] = True
+        if offer.get('stream_infiles'):
+            options['stream_infiles'] = True
+            if offer.get('infile_cache'):
+                options['infile_cache'] = True
+                if offer.get('infile_delta'):
+                    options['infile_delta'] = True
+        if offer.get('sessions'):
+            options['sessions'] = True
+        if offer.get('batch'):
+            options['batch'] = True
+        if offer.get('stream_stdin'):
+            options['stream_stdin'] = True
+        if offer.get('guard'):
+            options['guard'] = True
+        if offer.get('trace'):
+            options['trace'] = True
+        if version > 2:
+            # the client lists the methods it would like, best first
+            methods = [m for m in offer.get('compress', ()) if m in codec.methods]
+            if methods:
+                options['compress'] = methods[0]
+        return options
+
+    def hello(root, offer, path=None, conn=None):
+        """answer a render request, leaving out the tree if the client has it cached"""
+        options = cli.negotiate(offer)
+        if 'depth' in offer:
+            # only what the client asked for, with stubs it can fetch later
+            command = root.render(path or [], offer['depth'])
+            if offer.get('version') and offer['version'] == command.version():
+                command = None
+            if conn and offer.get('guard_call'):
+                # the client sent a call along with this, parsed with its cached tree
+                conn.guard = command is not None
+            return wire.Hello(options, command)
+        command = root.render()
+        if offer.get('version') and offer['version'] == command.version():
+            command = None
+        return wire.Hello(options, command)
 
     def serve_pipe(root, stdin, stdout):
+        conn = cli.Connection(stdin, stdout)
         sessions = []
+        options = {}
+
+        def poll(idx, file_handles):
+            timeout = cli.Session.LONG_POLL if options.get('long_poll') else 0
+            response = sessions[idx].poll(file_handles, timeout=timeout)
+            return cli.session_response(sessions, idx, response)
+
         while True:
-            line = stdin.readline().decode('ascii').strip()
-            if not line: 
-                break # blank line means it's probably over
-            size = int(line)
-            if size < 0: break
-            buf = stdin.read(size)
-            obj, _ = codec.parse(buf, 0)
+            obj = conn.read()
+            if obj is None:
+                break
 
+            start = time.perf_counter()
             try:
                 if obj.action == "render":
-                    response = root.render()
+                    if obj.argv is not None: 
+                        # only clients that know about Hello send options
+                        response = cli.hello(root, obj.argv, obj.path, conn)
+                        options = response.options
+                        conn.agree(options)
+                    else:
+                        response = root.render()
                 elif obj.action == "call":
                     # alternate take: create fork here, but then struggle
                     # to pass streams? 
-                    response = root.call(obj.path, obj.argv)
+                    response = cli.stale_call(conn) or root.call(obj.path, obj.argv)
                     if isinstance(response,wire.Session):
-                        sessions.append(response.idx)
-                        response = wire.Session(len(sessions)-1, response.value, response.file_handles)
+                        response = poll(cli.add_session(sessions, response.idx, options, conn.trace), {})
                 elif obj.action == "poll":
-                    s = sessions[obj.path]
-                    response = s.poll(obj.argv)
-                    if isinstance(response, wire.Response):
-                        sessions[obj.path] = None
-                    else:
-                        response = wire.Session(obj.path, response.value, response.file_handles)
+                    response = poll(obj.path, obj.argv)
             except Exception as e:
                 stdout.write(b'error: ')
                 stdout.write(str(e).encode('ascii'))
                 raise
 
-            buf = codec.dump(response, bytearray())
-
-            stdout.write(b"%d\n" % (len(buf)))
-            stdout.write(buf)
-            stdout.flush()
+            if conn.trace:
+                conn.trace.span(obj.action, start)
+            conn.write(response)
+            if options.get('sessions'):
+                return cli.serve_sessions(root, conn, options, sessions)
         for s in sessions:
             if s: s.close()
         return 0
 
+    def stale_call(conn):
+        """the refusal for a call sent along with a render that found the client's tree stale, if it was"""
+        if not conn.guard:
+            return None
+        conn.guard = False
+        return wire.Response(-1, None, file_handles={'console': b'error: command tree changed, call refused\n'})
+
+    class SessionTable(dict):
+        """
+            sessions by number, for a server that outlives its clients
+
+            finished sessions are removed rather than left as None, and
+            numbers are never reused, so a late poll for one finds nothing
+            rather than someone else's session
+        """
+        def __init__(self):
+            dict.__init__(self)
+            self.numbers = itertools.count()
+
+        def add(self, session):
+            idx = next(self.numbers)
+            self[idx] = session
+            return idx
+
+        def __setitem__(self, idx, session):
+            if session is None:
+                self.pop(idx, None)
+            else:
+                dict.__setitem__(self, idx, session)
+
+    def add_session(sessions, session, options, trace=None):
+        """keep a new session, set up for what its client agreed to, and return its number"""
+        session.deltas = options.get('infile_delta', False)
+        session.batch = options.get('batch', False)
+        session.stream_stdin = options.get('stream_stdin', False)
+        if trace:
+            session.trace = trace
+            trace.spans.append((trace.process, "fork", session.started, session.forked - session.started, {}))
+        if isinstance(sessions, cli.SessionTable):
+            return sessions.add(session)
+        sessions.append(session)
+        return len(sessions) - 1
+
+    def session_response(sessions, idx, response):
+        """number a session's output by its place in sessions, and forget finished ones"""
+        if isinstance(response, wire.Response):
+            sessions[idx] = None
+            return response
+        return wire.Session(idx, response.value, response.file_handles, response.credits)
+
+    def serve_sessions(root, conn, options, sessions):
+        """
+            serve tagged frames, running many sessions at once
+
+            a poll is parked until its session has something to say, or the
+            long poll runs out, while other frames are read and answered.
+            requests sent before the client read the hello aren't tagged,
+            and are answered without one, in the order they were sent
+
+            replies are written without blocking, and whatever doesn't fit
+            waits for the pipe to drain, so a client busy sending a request
+            is never stuck waiting on a server stuck sending it a reply
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(conn.reader, selectors.EVENT_READ)
+        parked = {} # session idx -> (tag, deadline, fileobjs watched)
+        polled = {} # session idx -> when the waiting poll arrived, for tracing
+        long_poll = cli.Session.LONG_POLL if options.get('long_poll') else 0
+        out = bytearray() # replies not yet written
+        conn.writer.flush()
+        fd = conn.writer.fileno()
+        shared = fd == conn.reader.fileno() # a socket, read and written through one fd
+        os.set_blocking(fd, False)
+
+        def park(tag, idx, file_handles):
+            polled[idx] = time.perf_counter()
+            session = sessions[idx]
+            session.feed(file_handles)
+            if long_poll and not session.wait(0):
+                watched = []
+                for key in list(session.selector.get_map().values()):
+                    selector.register(key.fileobj, key.events, idx)
+                    watched.append(key.fileobj)
+                parked[idx] = (tag, time.monotonic() + long_poll, watched)
+            else:
+                reply(tag, idx)
+
+        def reply(tag, idx):
+            response = cli.session_response(sessions, idx, sessions[idx].collect())
+            if conn.trace:
+                conn.trace.span("poll", polled[idx], session=idx)
+            answer(tag, response)
+
+        def answer(tag, response):
+            size, buf = conn.frame(response if tag is None else wire.Frame(tag, response))
+            waiting = bool(out)
+            out.extend(size)
+            out.extend(buf)
+            if not waiting:
+                drain()
+
+        def drain():
+            try:
+                while out:
+                    del out[:os.write(fd, out)]
+            except BlockingIOError:
+                pass
+            # watch for the pipe draining, only while there's more to write
+            if shared:
+                selector.modify(conn.reader, selectors.EVENT_READ | (selectors.EVENT_WRITE if out else 0))
+            elif out and conn.writer not in selector.get_map():
+                selector.register(conn.writer, selectors.EVENT_WRITE, "out")
+            elif not out and conn.writer in selector.get_map():
+                selector.unregister(conn.writer)
+
+        def unpark(idx):
+            tag, deadline, watched = parked.pop(idx)
+            for fileobj in watched:
+                selector.unregister(fileobj)
+            return tag
+
+        try:
+            while True:
+                while conn.frames:
+                    frame = conn.frames.popleft()
+                    if isinstance(frame, wire.Frame):
+                        tag, obj = frame.tag, frame.body
+                    else:
+                        tag, obj = None, frame
+                    start = time.perf_counter()
+                    if obj.action == "render":
+                        response = cli.hello(root, obj.argv or {}, obj.path, conn)
+                        response.options = options # already agreed
+                    elif obj.action == "call":
+                        response = cli.stale_call(conn) or root.call(obj.path, obj.argv)
+                        if isinstance(response, wire.Session):
+                            park(tag, cli.add_session(sessions, response.idx, options, conn.trace), {})
+                            continue
+                    elif obj.action == "poll":
+                        if obj.path in parked: # superseded, so answer the old one now
+                            reply(unpark(obj.path), obj.path)
+                        park(tag, obj.path, obj.argv)
+                        continue
+                    if conn.trace:
+                        conn.trace.span(obj.action, start)
+                    answer(tag, response)
+
+                if conn.decoder.closed:
+                    return 0 # the client ended the stream, but may still hold the pipe open
+                timeout = None
+                if parked:
+                    timeout = max(0, min(p[1] for p in parked.values()) - time.monotonic())
+                ready = set()
+                for key, events in selector.select(timeout):
+                    if key.fd == fd and events & selectors.EVENT_WRITE:
+                        drain()
+                    if key.data is None:
+                        if events & selectors.EVENT_READ and not conn.fill():
+                            return 0
+                    elif key.data != "out":
+                        ready.add(key.data)
+                now = time.monotonic()
+                for idx in list(parked):
+                    if idx in ready or parked[idx][1] <= now:
+                        if idx in ready and not sessions[idx].wait(0) and parked[idx][1] > now:
+                            continue # an infile drained, but there's nothing to send yet
+                        reply(unpark(idx), idx)
+        finally:
+            selector.close()
+            os.set_blocking(fd, True)
+            try:
+                conn.writer.write(out) # what's left, for a client that's still reading
+                conn.writer.flush()
+            except OSError:
+                pass
+            for s in sessions:
+                if s: s.close()
+
+    async def wait_async(session, timeout):
+        """like Session.wait, but giving way to the event loop until the session is ready"""
+        if session.wait(0):
+            return True
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(True)
+
+        watched = list(session.selector.get_map().values())
+        for key in watched:
+            if key.events & selectors.EVENT_READ:
+                loop.add_reader(key.fileobj, wake)
+            if key.events & selectors.EVENT_WRITE:
+                loop.add_writer(key.fileobj, wake)
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for key in watched:
+                if key.events & selectors.EVENT_READ:
+                    loop.remove_reader(key.fileobj)
+                if key.events & selectors.EVENT_WRITE:
+                    loop.remove_writer(key.fileobj)
+        return session.wait(0)
+
+    async def serve_async(root, reader, writer):
+        """
+            serve_pipe, over asyncio streams
+
+            tagged frames are each answered by their own task, so one event
+            loop can run many sessions for many connections at once
+        """
+        conn = cli.AsyncConnection(reader, writer)
+        sessions = []
+        options = {}
+        tasks = set()
+
+        async def poll(idx, file_handles):
+            session = sessions[idx]
+            session.feed(file_handles)
+            if options.get('long_poll'):
+                await cli.wait_async(session, cli.Session.LONG_POLL)
+            return cli.session_response(sessions, idx, session.collect())
+
+        async def handle(obj):
+            if obj.action == "render":
+                if obj.argv is None:
+                    return root.render()
+                response = cli.hello(root, obj.argv, obj.path, conn)
+                if options:
+                    response.options = options # already agreed
+                else:
+                    options.update(response.options)
+                    conn.agree(options)
+                return response
+            elif obj.action == "call":
+                response = cli.stale_call(conn) or root.call(obj.path, obj.argv)
+                if isinstance(response, wire.Session):
+                    response = await poll(cli.add_session(sessions, response.idx, options, conn.trace), {})
+                return response
+            elif obj.action == "poll":
+                return await poll(obj.path, obj.argv)
+
+        async def reply(frame):
+            try:
+                response = await handle(frame.body)
+                await conn.write(wire.Frame(frame.tag, response))
+            except Exception:
+                traceback.print_exc()
+                writer.close() # so the client sees the end, rather than waiting forever
+
+        try:
+            while True:
+                obj = await conn.read()
+                if obj is None:
+                    break
+                if isinstance(obj, wire.Frame):
+                    task = asyncio.ensure_future(reply(obj))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await conn.write(await handle(obj))
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks: # before closing the pipes they may still be watching
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for s in sessions:
+                if s: s.close()
+            writer.close()
+        return 0
+
+    async def serve_pipe_async(root, stdin, stdout):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin)
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, stdout)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        return await cli.serve_async(root, reader, writer)
+
+    def peer(sock):
+        """who is on the other end of a unix socket, to keep their cached infiles apart"""
+        try:
+            pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        except (AttributeError, OSError): # no SO_PEERCRED here
+            return "socket"
+        return "uid:{}".format(uid)
+
+    async def listen_async(root, path):
+        """serve any number of clients over a unix socket"""
+        async def serve(reader, writer):
+            cli.FileCache.client.set(cli.peer(writer.get_extra_info('socket')))
+            return await cli.serve_async(root, reader, writer)
+        server = await asyncio.start_unix_server(serve, path)
+        async with server:
+            await server.serve_forever()
+
+    def serve_zygote(root, path, workers=4):
+        """
+            keep a warm process, and serve each connection from a fork of it
+
+            a few workers are forked ahead of time, each waiting to accept
+            one connection on a unix socket and serve it, and each is
+            replaced as soon as it is taken, so a new connection costs a
+            connect rather than an interpreter start, imports, and warmup.
+            connect with `textfree86.py --attach <path>` as the pipe command
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        idle = set() # workers waiting to accept
+        busy = set() # and ones serving a connection
+        taken_r, taken_w = os.pipe() # each worker writes its pid here once it accepts
+        wake_r, wake_w = os.pipe() # and SIGCHLD wakes the loop through here
+        os.set_blocking(taken_r, False)
+        os.set_blocking(wake_r, False)
+        os.set_blocking(wake_w, False)
+
+        def fork():
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for fd in (taken_r, wake_r, wake_w):
+                    os.close(fd)
+                code = 0
+                try:
+                    sock, _ = listener.accept()
+                    os.write(taken_w, b"%d\n" % os.getpid()) # one write, so it arrives whole
+                    os.close(taken_w)
+                    listener.close()
+                    cli.FileCache.client.set(cli.peer(sock))
+                    code = cli.serve_pipe(root, sock.makefile('rb'), sock.makefile('wb'))
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+            idle.add(pid)
+
+        def reap():
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    return
+                if pid == 0:
+                    return
+                idle.discard(pid) # one that died before it was taken is replaced too
+                busy.discard(pid)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wake_w)
+        selector = selectors.DefaultSelector()
+        selector.register(taken_r, selectors.EVENT_READ)
+        selector.register(wake_r, selectors.EVENT_READ)
+        pending = b""
+        try:
+            while True:
+                reap()
+                while len(idle) < workers:
+                    fork()
+                selector.select()
+                try:
+                    while True:
+                        os.read(wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                try:
+                    while True:
+                        data = os.read(taken_r, 4096)
+                        if not data:
+                            break
+                        pending += data
+                except BlockingIOError:
+                    pass
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    pid = int(line)
+                    if pid in idle: # and not already reaped
+                        idle.discard(pid)
+                        busy.add(pid)
+        finally:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for pid in idle | busy:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            selector.close()
+            for fd in (taken_r, taken_w, wake_r, wake_w):
+                os.close(fd)
+            listener.close()
+            os.unlink(path)
+        return 0
+
+    def attach(path):
+        """pass stdin and stdout to and from a unix socket, to reach a zygote over ssh"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(stdin, selectors.EVENT_READ)
+        selector.register(sock, selectors.EVENT_READ)
+        while True:
+            for key, events in selector.select():
+                if key.fileobj is sock:
+                    data = sock.recv(65536)
+                    if not data:
+                        return 0
+                    while data:
+                        data = data[os.write(stdout, data):]
+                else:
+                    data = os.read(stdin, 65536)
+                    if data:
+                        sock.sendall(data)
+                    else:
+                        selector.unregister(stdin)
+                        sock.shutdown(socket.SHUT_WR)
+
+    HTTP_ADDRESS = "127.0.0.1:8086"
+    HTTP_EXPIRE = 60 # seconds a session may go unpolled before it's stopped
+    HTTP_TYPE = "application/x-textfree86"
+
+    def http_body(obj):
+        """a frame of the schema-less compact encoding, as each request stands alone"""
+        buf = codec.dump_compact(obj, bytearray())
+        return b"%d\n" % len(buf) + buf
+
+    def http_parse(body):
+        frames = codec.Decoder().feed(body)
+        return frames[0] if frames else None
+
+    async def serve_http(root, host, port):
+        """
+            serve render as a GET, with the tree's version as its ETag, and
+            call and poll as POSTs, long polled, over keep-alive connections
+
+            sessions belong to the server, not the connection, so a client
+            can reconnect to poll one, and ones left unpolled for
+            HTTP_EXPIRE seconds are taken to be abandoned, and stopped
+        """
+        sessions = cli.SessionTable()
+        polled = {} # session idx -> when it was last polled
+        connections = itertools.count() # to keep each one's cached infile names apart
+
+        async def poll(idx, file_handles):
+            session = sessions[idx]
+            polled[idx] = time.monotonic()
+            session.feed(file_handles)
+            await cli.wait_async(session, cli.Session.LONG_POLL)
+            polled[idx] = time.monotonic()
+            return cli.session_response(sessions, idx, session.collect())
+
+        async def expire():
+            while True:
+                await asyncio.sleep(cli.HTTP_EXPIRE / 4)
+                cutoff = time.monotonic() - cli.HTTP_EXPIRE
+                for idx, when in list(polled.items()):
+                    if idx not in sessions:
+                        del polled[idx]
+                    elif when < cutoff:
+                        del polled[idx]
+                        sessions.pop(idx).close()
+
+        async def handle(method, headers, body):
+            if method in ("GET", "HEAD"):
+                command = root.render()
+                etag = '"{}"'.format(command.version())
+                if headers.get('if-none-match') == etag:
+                    return "304 Not Modified", {'ETag': etag}, b""
+                return "200 OK", {'ETag': etag, 'Cache-Control': 'no-cache'}, cli.http_body(command)
+            elif method == "POST":
+                obj = cli.http_parse(body)
+                if not isinstance(obj, wire.Request) or obj.action not in ("call", "poll"):
+                    return "400 Bad Request", {}, b""
+                if obj.action == "call":
+                    response = root.call(obj.path, obj.argv)
+                    if isinstance(response, wire.Session):
+                        # the http client always takes deltas and batches, and streams stdin
+                        response = await poll(cli.add_session(sessions, response.idx, {'infile_delta': True, 'batch': True, 'stream_stdin': True}), {})
+                else:
+                    if not (isinstance(obj.path, int) and obj.path in sessions):
+                        return "404 Not Found", {}, b""
+                    response = await poll(obj.path, obj.argv)
+                return "200 OK", {}, cli.http_body(response)
+            return "405 Method Not Allowed", {'Allow': 'GET, HEAD, POST'}, b""
+
+        async def connection(reader, writer):
+            cli.FileCache.client.set("http:{}".format(next(connections)))
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    method, target, version = line.decode('latin-1').split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if not line.strip():
+                            break
+                        name, value = line.decode('latin-1').split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                    status, extra, payload = await handle(method, headers, body)
+                    keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != 'close'
+                    head = ["HTTP/1.1 {}".format(status)]
+                    if payload:
+                        head.append("Content-Type: {}".format(cli.HTTP_TYPE))
+                    head.append("Content-Length: {}".format(len(payload)))
+                    head.extend("{}: {}".format(k, v) for k, v in extra.items())
+                    if not keep_alive:
+                        head.append("Connection: close")
+                    writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+                    if method != "HEAD":
+                        writer.write(payload)
+                    await writer.drain()
+                    if not keep_alive:
+                        break
+            except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+                pass # a malformed request, or the client went away
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(connection, host, port)
+        expiry = asyncio.ensure_future(expire())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            for session in list(sessions.values()):
+                session.close()
+
     class PipeClient:
-        def __init__(self, request, response):
-            self.request = request 
-            self.response = response
+        """
+            sends requests down a pipe, and can be shared between threads
+
+            submit() sends a request without waiting, and result() waits for
+            its reply, so many requests can be in flight at once. once the
+            server agrees to 'sessions', requests are tagged and answered in
+            any order, and whichever thread is waiting reads replies for all
+            of them, so a slow poll from one thread doesn't hold up the others.
+            until then, replies come back in the order requests were sent
+
+            requests are written under a lock of their own, so a thread stuck
+            sending a large one never stops another from reading replies
+        """
+        OFFER = {'long_poll': True, 'stream_infiles': True, 'infile_cache': True, 'infile_delta': True, 'batch': True, 'stream_stdin': True, 'guard': True, 'codec': codec.VERSION, 'sessions': True}
+        LOCAL = ('infile_cache', 'infile_delta') # not offered to a server forked by the client, where they only cost disk
+        COMPRESS = ['zlib'] # only offered to a remote server, as a local pipe is faster than compressing
+        DEPTH = 0 # levels filled in below the end of a path, when rendering one
+
+        def __init__(self, request, response, trace=None, local=False, remote=False):
+            self.conn = cli.Connection(response, request)
+            self.conn.trace = trace
+            self.local = local
+            self.remote = remote
+            self.options = {}
+            self.lock = threading.Condition()
+            self.write_lock = threading.Lock() # taken before lock, never while holding it
+            self.tickets = itertools.count(1)
+            self.untagged = collections.deque() # tickets sent before tags were agreed, oldest first
+            self.replies = {} # ticket -> reply, for threads still waiting
+            self.started = {} # ticket -> (action, start), when tracing
+            self.reading = False
+            self.closed = False
 
         def send(self, name, path, argv):
-            obj = wire.Request(name, path, argv)
-            buf = codec.dump(obj, bytearray())
-            self.request.write(b"%d\n"%(len(buf)))
-            self.request.write(buf)
-            self.request.flush()
-            size = int(self.response.readline().strip())
-            buf = self.response.read(size)
-            obj, _ = codec.parse(buf, 0)
-            return obj
+            return self.result(self.submit(name, path, argv))
+
+        def submit(self, name, path, argv):
+            """send a request without waiting for the reply, returning a ticket for result()"""
+            request = wire.Request(name, path, argv)
+            with self.write_lock:
+                with self.lock:
+                    ticket = next(self.tickets)
+                    if self.conn.trace:
+                        self.started[ticket] = (name, time.perf_counter())
+                    tagged = self.options.get('sessions')
+                    if not tagged:
+                        self.untagged.append(ticket)
+                self.conn.write(wire.Frame(ticket, request) if tagged else request)
+            return ticket
+
+        def result(self, ticket):
+            """wait for the reply to a submitted request, or None if the connection closed"""
+            with self.lock:
+                while ticket not in self.replies:
+                    if self.closed:
+                        return None
+                    if self.reading:
+                        self.lock.wait()
+                        continue
+                    self.reading = True
+                    self.lock.release()
+                    try:
+                        frame = self.conn.read()
+                    finally:
+                        self.lock.acquire()
+                        self.reading = False
+                    if frame is None:
+                        self.closed = True
+                    elif isinstance(frame, wire.Frame):
+                        self.replies[frame.tag] = frame.body
+                    else:
+                        self.replies[self.untagged.popleft()] = frame
+                    self.lock.notify_all()
+                if ticket in self.started:
+                    name, start = self.started.pop(ticket)
+                    self.conn.trace.span(name, start)
+                return self.replies.pop(ticket)
 
         def call(self, path, argv):
             return self.send("call", path, argv)
 
-        def render(self):
-            return self.send("render", None, None)
+        def render(self, version=None, path=None):
+            """
+                fetch the command tree, or None if it matches the version given
+
+                given a path, newer servers send only the commands along it,
+                and stubs for the rest, and compare the version to those
+            """
+            return self.rendered(self.submit_render(version, path))
+
+        def submit_render(self, version=None, path=None, guard=False):
+            """
+                send a render request without waiting, for rendered() to read
+
+                with guard, the server refuses the call sent next if the
+                version turns out to be stale, so a call can follow at once
+            """
+            offer = dict(self.OFFER)
+            if self.local:
+                for name in self.LOCAL:
+                    offer.pop(name, None)
+            if self.remote:
+                offer['compress'] = self.COMPRESS
+            if version:
+                offer['version'] = version
+            if path is not None:
+                offer['depth'] = self.DEPTH
+            if guard:
+                offer['guard_call'] = True
+            if self.conn.trace:
+                offer['trace'] = True
+            return self.submit("render", path, offer)
+
+        def rendered(self, ticket):
+            obj = self.result(ticket)
+            if obj is None:
+                raise EOFError('connection closed before render')
+            if isinstance(obj, wire.Hello):
+                self.options = obj.options
+                self.conn.agree(obj.options)
+                obj = obj.command
+            return obj
 
         def poll(self, idx, file_handles):
+            if not self.options.get('long_poll'):
+                time.sleep(0.300) # older servers answer at once, so don't spin
             return self.send("poll", idx, file_handles)
 
 
+    class AsyncPipeClient:
+        """
+            a PipeClient for asyncio, where render, call, and poll are coroutines
+
+            once the server agrees to 'sessions', any number of tasks can
+            have requests outstanding, and replies are handed out by tag
+        """
+        OFFER = {'long_poll': True, 'stream_infiles': True, 'infile_cache': True, 'infile_delta': True, 'codec': codec.VERSION, 'sessions': True}
+        COMPRESS = ['zlib']
+
+        def __init__(self, reader, writer, process=None, remote=False):
+            self.conn = cli.AsyncConnection(reader, writer)
+            self.process = process
+            self.remote = remote
+            self.options = {}
+            self.lock = asyncio.Lock()
+            self.tags = itertools.count(1)
+            self.waiting = {} # tag -> future
+            self.dispatcher = None
+
+        @staticmethod
+        async def spawn(cmd):
+            process = await asyncio.create_subprocess_shell(
+                cmd,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+            )
+            return cli.AsyncPipeClient(process.stdout, process.stdin, process, remote=cli.remote(cmd))
+
+        async def send(self, name, path, argv):
+            request = wire.Request(name, path, argv)
+            if not self.options.get('sessions'):
+                async with self.lock:
+                    await self.conn.write(request)
+                    return await self.conn.read()
+            tag = next(self.tags)
+            reply = asyncio.get_running_loop().create_future()
+            self.waiting[tag] = reply
+            await self.conn.write(wire.Frame(tag, request))
+            if self.dispatcher is None:
+                self.dispatcher = asyncio.ensure_future(self.dispatch())
+            return await reply
+
+        async def dispatch(self):
+            while True:
+                frame = await self.conn.read()
+                if frame is None:
+                    break
+                reply = self.waiting.pop(frame.tag, None)
+                if reply and not reply.done():
+                    reply.set_result(frame.body)
+            for reply in self.waiting.values():
+                if not reply.done():
+                    reply.set_result(None)
+            self.waiting.clear()
+
+        async def call(self, path, argv):
+            return await self.send("call", path, argv)
+
+        async def render(self, version=None):
+            offer = dict(self.OFFER)
+            if self.remote:
+                offer['compress'] = self.COMPRESS
+            if version:
+                offer['version'] = version
+            obj = await self.send("render", None, offer)
+            if obj is None:
+                raise EOFError('connection closed before render')
+            if isinstance(obj, wire.Hello):
+                self.options = obj.options
+                self.conn.agree(obj.options)
+                obj = obj.command
+            return obj
+
+        async def poll(self, idx, file_handles):
+            if not self.options.get('long_poll'):
+                await asyncio.sleep(0.300)
+            return await self.send("poll", idx, file_handles)
+
+        async def close(self):
+            self.conn.writer.write(b'-1\n')
+            await self.conn.writer.drain()
+            self.conn.writer.close()
+            if self.dispatcher:
+                await self.dispatcher
+            if self.process:
+                await self.process.wait()
+
+    class CompletionIndex:
+        """
+            the names to complete at each command, kept beside a cached tree
+
+            each command is an entry of its subcommand names, where their
+            entries start, and its flags as they'd be typed, written after
+            its subcommands', so completing decodes only the entries along
+            the path, rather than the whole tree
+        """
+        def __init__(self, path):
+            self.path = path
+
+        def save(self, command):
+            buf = bytearray()
+            root = self.add(command, buf)
+            try:
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, 'wb') as fh:
+                    fh.write(b"%d\n" % root)
+                    fh.write(buf)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+        def add(self, command, buf):
+            names = offsets = flags = None
+            if command.subcommands is not None: # or a stub, to be fetched before completing
+                names = list(command.subcommands)
+                offsets = [self.add(command.subcommands[name], buf) for name in names]
+            if command.argspec:
+                argspec = command.argspec
+                flags = ["--{}".format(x) for x in argspec.switches] + ["--{}=".format(x) for x in argspec.flags + argspec.lists]
+            start = len(buf)
+            codec.dump_compact([names, offsets, flags], buf)
+            return start
+
+        def complete(self, path, text):
+            """the same as Command.complete, or None without an index, or at a stub"""
+            try:
+                with open(self.path, 'rb') as fh:
+                    data = fh.read()
+                line_end = data.index(b"\n")
+                base = line_end + 1
+                names, offsets, flags = codec.parse(data, base + int(data[:line_end]))[0]
+                while True:
+                    if names is None:
+                        return None
+                    if path and path[0] in names:
+                        names, offsets, flags = codec.parse(data, base + offsets[names.index(path[0])])[0]
+                        path = path[1:]
+                        continue
+                    elif not path:
+                        output = [name for name in names if name.startswith(text)]
+                        if output:
+                            return output
+                    break
+            except Exception:
+                return None # a corrupt index is a missing one
+            if text.startswith('-'):
+                prefix = text[2:] if text.startswith('--') else text[1:]
+                if '=' in prefix:
+                    return ()
+                return [flag for flag in flags or () if flag[2:].startswith(prefix)]
+            return ()
+
+    class CachedClient:
+        """
+            a PipeClient that keeps the rendered command tree on disk
+
+            completion and help are answered from the cache, and the command
+            is only started when something needs to be called, or when
+            the cached tree turns out to be stale. completion reads just the
+            part of the CompletionIndex along its path, written with the tree
+        """
+        def __init__(self, cmd, mux=False, trace=None):
+            self.cmd = cmd
+            self.mux = mux
+            self.trace = trace
+            self.path = cli.cache_path(cmd)
+            self.index = cli.CompletionIndex(cli.cache_path(cmd, ".index"))
+            self.process = None
+            self.sock = None
+            self.client = None
+            self.command = None
+            self.options = {}
+            self.known = {} # the options agreed the last time, kept with the tree
+            self.wanted = None # the path the tree must be filled in along
+
+        def load(self):
+            try:
+                with open(self.path, 'rb') as fh:
+                    obj, _ = codec.parse(fh.read())
+            except Exception:
+                return None # a corrupt cache is a missing one
+            if isinstance(obj, wire.Hello):
+                self.known = obj.options
+                obj = obj.command
+            if not isinstance(obj, wire.Command):
+                return None
+            if not os.path.exists(self.index.path): # cached before there were indexes
+                self.index.save(obj)
+            return obj
+
+        def save(self, command):
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if os.path.exists(self.index.path):
+                    os.unlink(self.index.path) # rather than leave it describing the old tree
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, 'wb') as fh:
+                    # compact, as it's parsed for every completion, and older caches still load
+                    fh.write(codec.dump_compact(wire.Hello(self.options, command), bytearray()))
+                os.replace(tmp, self.path)
+                self.known = self.options
+            except OSError:
+                return # a cache we can't write is just a slower cache
+            self.index.save(command)
+
+        def complete(self, path, text):
+            """complete from the index, or None if the tree is needed"""
+            return self.index.complete(path, text)
+
+        def start(self):
+            """start the command, or connect to its mux"""
+            if self.mux:
+                self.sock = cli.Mux.connect(self.cmd)
+                self.client = cli.PipeClient(self.sock.makefile('wb'), self.sock.makefile('rb'), self.trace)
+            else:
+                self.process = subprocess.Popen(
+                    self.cmd,
+                    shell = True,
+                    stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                )
+                self.client = cli.PipeClient(self.process.stdin, self.process.stdout, self.trace, remote=cli.remote(self.cmd))
+
+        def cached_version(self):
+            """the version of the cached tree, or of the part of it the server will render"""
+            if self.command is None:
+                return None
+            if self.wanted is None:
+                return self.command.version()
+            return self.command.render(self.wanted, self.client.DEPTH).version()
+
+        def connect(self, retry=False, path=None):
+            """start the command, and return the live command tree, filled in along path"""
+            if path is not None:
+                self.wanted = path
+            if self.client is None:
+                start = time.perf_counter()
+                self.start()
+                cached = self.command
+                try:
+                    command = self.client.render(self.cached_version(), self.wanted)
+                except (EOFError, OSError):
+                    if not self.mux or retry:
+                        raise
+                    # the mux was shutting down as we connected, so start another
+                    self.sock.close()
+                    self.sock = self.client = None
+                    return self.connect(retry=True)
+                self.options = self.client.options
+                if self.trace:
+                    self.trace.span("connect", start)
+                if command is None:
+                    command = cached
+                else:
+                    command = command.graft(cached)
+                if cached is None or command is not cached or self.options != self.known:
+                    self.save(command)
+                self.command = command
+            elif self.wanted is not None and self.command.stub_along(self.wanted):
+                self.command = self.client.render(None, self.wanted).graft(self.command)
+                self.save(self.command)
+            return self.command
+
+        def render(self, path=None):
+            if self.command is None:
+                self.command = self.load()
+            if self.command is None:
+                return self.connect(path=path)
+            elif path is None and self.command.partial():
+                return self.connect() # the whole tree is wanted, but only some is cached
+            elif path is not None and self.command.stub_along(path):
+                return self.connect(path=path)
+            return self.command
+
+        def call(self, path, argv):
+            self.connect()
+            return self.client.call(path, argv)
+
+        def call_ahead(self, path, argv):
+            """
+                check the cached tree and call the command, or return None if
+                the tree was stale and the arguments need parsing again
+
+                when starting a command that has agreed to 'guard' before, the
+                call is sent along with the render rather than after it, and
+                the server refuses it if the tree is stale, saving a round trip
+            """
+            if self.client is not None or self.mux or not self.known.get('guard'):
+                command = self.command
+                if self.connect(path=path) is not command:
+                    return None
+                return self.call(path, argv)
+            start = time.perf_counter()
+            self.wanted = path
+            self.start()
+            cached = self.command
+            render = self.client.submit_render(self.cached_version(), path, guard=True)
+            call = self.client.submit("call", path, argv)
+            command = self.client.rendered(render)
+            self.options = self.client.options
+            if self.trace:
+                self.trace.span("connect", start)
+            result = self.client.result(call)
+            if command is None:
+                return result
+            self.command = command.graft(cached)
+            self.save(self.command)
+            if self.options.get('guard'):
+                return None # refused, as it was parsed with the stale tree
+            return result # a server that can't refuse calls ran it anyway
+
+        def poll(self, idx, file_handles):
+            return self.client.poll(idx, file_handles)
+
+        def close(self):
+            if self.process:
+                self.process.stdin.write(b'-1\n') # break out of readline()
+                self.process.stdin.close()
+                self.process.wait()
+            elif self.sock:
+                try:
+                    self.client.conn.writer.write(b'-1\n')
+                    self.client.conn.writer.flush()
+                except OSError:
+                    pass # the mux went away first
+                self.sock.close()
+
+    class Mux:
+        """
+            one connection to a pipe command, shared by many clients
+
+            clients connect over a unix socket beside the render cache, and
+            their requests are forwarded over the connection, concurrently
+            if the command serves sessions, or one at a time if not.
+            the mux is started by the first client to need it, and exits
+            once it has been idle for a while, or the command goes away
+        """
+        IDLE = 600
+        START = 30
+
+        def __init__(self, cmd):
+            self.cmd = cmd
+            self.path = cli.cache_path(cmd, ".sock")
+            self.clients = []
+            self.listener = None
+            self.process = None
+            self.upstream = None
+            self.command = None
+
+        @staticmethod
+        def connect(cmd):
+            """connect to the mux for a command, starting one if needed"""
+            path = cli.cache_path(cmd, ".sock")
+            process = None
+            deadline = time.monotonic() + cli.Mux.START
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(path)
+                    return sock
+                except (FileNotFoundError, ConnectionRefusedError):
+                    sock.close()
+                if process is None:
+                    process = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__), '--mux-serve', cmd],
+                        stdin = subprocess.DEVNULL,
+                        stdout = subprocess.DEVNULL,
+                        stderr = subprocess.DEVNULL,
+                        start_new_session = True,
+                    )
+                elif process.poll() is not None and not os.path.exists(path):
+                    raise Exception('mux for {!r} exited with {}'.format(cmd, process.returncode))
+                if time.monotonic() > deadline:
+                    raise Exception('mux for {!r} did not start'.format(cmd))
+                time.sleep(0.05)
+
+        def render(self, path=None, depth=None):
+            return self.command.render(path, depth)
+
+        def serve(self):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                return 0 # someone else got there first
+            except FileNotFoundError:
+                pass
+            except ConnectionRefusedError:
+                os.unlink(self.path) # left behind by a mux that died
+            finally:
+                probe.close()
+
+            self.process = subprocess.Popen(
+                self.cmd,
+                shell = True,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+            )
+            self.upstream = cli.PipeClient(self.process.stdin, self.process.stdout, remote=cli.remote(self.cmd))
+            self.command = self.upstream.render()
+
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.path)
+            self.listener.listen()
+            self.listener.settimeout(self.IDLE)
+            try:
+                while True:
+                    try:
+                        sock, _ = self.listener.accept()
+                    except socket.timeout:
+                        self.clients = [t for t in self.clients if t.is_alive()]
+                        if self.clients:
+                            continue
+                        break
+                    except OSError: # closed by shutdown()
+                        break
+                    if self.process.poll() is not None:
+                        sock.close() # the command went away while idle
+                        break
+                    sock.settimeout(None)
+                    client = threading.Thread(target=self.handle, args=(sock,), daemon=True)
+                    client.start()
+                    self.clients.append(client)
+            finally:
+                self.shutdown()
+                self.process.stdin.write(b'-1\n')
+                self.process.stdin.close()
+                self.process.wait()
+            return 0
+
+        def shutdown(self):
+            if self.listener and self.listener.fileno() != -1:
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
+                try:
+                    self.listener.shutdown(socket.SHUT_RDWR) # wake up accept()
+                except OSError:
+                    pass
+                self.listener.close()
+
+        def handle(self, sock):
+            conn = cli.Connection(sock.makefile('rb'), sock.makefile('wb'))
+            try:
+                while True:
+                    obj = conn.read()
+                    if obj is None:
+                        break
+                    if obj.action == "render":
+                        if obj.argv is not None:
+                            response = cli.hello(self, obj.argv, obj.path, conn)
+                            response.options.pop('sessions', None) # one request at a time, per client
+                            response.options.pop('compress', None) # not worth it over a local socket
+                            for name in ('long_poll', 'stream_infiles', 'infile_cache', 'infile_delta', 'batch', 'stream_stdin'):
+                                # the client can't have what the command doesn't offer
+                                if not self.upstream.options.get(name):
+                                    response.options.pop(name, None)
+                            conn.agree(response.options)
+                        else:
+                            response = self.command
+                    elif obj.action == "call" and conn.guard:
+                        response = cli.stale_call(conn)
+                    else:
+                        try:
+                            response = self.upstream.send(obj.action, obj.path, obj.argv)
+                        except OSError:
+                            response = None
+                        if response is None:
+                            self.shutdown() # the command went away
+                            break
+                    conn.write(response)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                sock.close()
+
+    class HTTPClient(CachedClient):
+        """
+            a CachedClient for a command served with --http
+
+            the cached tree is checked with a conditional GET, rather than
+            by starting anything, and requests are POSTed over one
+            keep-alive connection
+        """
+        def __init__(self, url):
+            cli.CachedClient.__init__(self, url)
+            url = urllib.parse.urlsplit(url)
+            self.http = http.client.HTTPConnection(url.hostname, url.port or 80)
+            self.target = url.path or "/"
+            self.options = {'long_poll': True, 'stream_infiles': True, 'infile_cache': True, 'infile_delta': True, 'batch': True, 'stream_stdin': True}
+            self.checked = False
+
+        def request(self, method, body=None, headers=None):
+            headers = dict(headers or {})
+            if body is not None:
+                headers['Content-Type'] = cli.HTTP_TYPE
+            self.http.request(method, self.target, body=body, headers=headers)
+            response = self.http.getresponse()
+            return response.status, response.read()
+
+        def connect(self, retry=False, path=None):
+            if not self.checked: # always the whole tree, so it can be cached by etag
+                cached = self.command
+                headers = {'If-None-Match': '"{}"'.format(cached.version())} if cached else {}
+                status, body = self.request("GET", headers=headers)
+                if status == 304:
+                    command = cached
+                elif status == 200:
+                    command = cli.http_parse(body)
+                    self.save(command)
+                else:
+                    raise Exception('bad response to render: {}'.format(status))
+                self.command = command
+                self.checked = True
+            return self.command
+
+        def send(self, name, path, argv):
+            status, body = self.request("POST", cli.http_body(wire.Request(name, path, argv)))
+            if status != 200:
+                raise Exception('bad response to {}: {}'.format(name, status))
+            return cli.http_parse(body)
+
+        def call(self, path, argv):
+            self.connect()
+            return self.send("call", path, argv)
+
+        def poll(self, idx, file_handles):
+            return self.send("poll", idx, file_handles)
+
+        def close(self):
+            self.http.close()
+
+    class Digests:
+        """
+            the sha256 of files sent before, so unchanged files aren't read
+            twice just to find out the server has them already
+
+            a file counts as unchanged if its size, mtime, ctime and inode
+            all match. mtime alone can be set back, by touch -r or rsync -t,
+            but ctime can't, and changes whenever the file is written
+        """
+        def __init__(self):
+            self.path = os.path.join(cli.cache_dir(), 'digests')
+            self.changed = False
+            try:
+                with open(self.path, 'rb') as fh:
+                    self.known, _ = codec.parse(fh.read())
+            except Exception:
+                self.known = {}
+
+        def digest(self, name):
+            """the sha256 of a regular file, or None for a pipe, which can only be read once"""
+            path = os.path.abspath(name)
+            st = os.stat(path)
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            key = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+            known = self.known.get(path)
+            if known and known[:-1] == key:
+                return known[-1]
+            digest = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.known[path] = key + [digest.hexdigest()]
+            self.changed = True
+            return self.known[path][-1]
+
+        def save(self):
+            if not self.changed:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, 'wb') as fh:
+                    fh.write(codec.dump(self.known, bytearray()))
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+    class StdinReader:
+        """
+            the client's end of a session's stdin, read only once select()
+            says there is something to read, and no more than the credit given
+
+            stdin is left blocking, as it may be shared with other processes,
+            and a file on disk, which select() can't watch, is always ready
+        """
+        def __init__(self, fd):
+            self.fd = fd
+            self.done = False
+            self.selector = selectors.DefaultSelector()
+            try:
+                self.selector.register(fd, selectors.EVENT_READ)
+            except PermissionError: # a regular file
+                self.selector.close()
+                self.selector = None
+            except (ValueError, OSError): # closed
+                self.close()
+
+        def read(self, credit):
+            """the next chunk, b'' once at eof, or None if there's nothing to send yet"""
+            if self.done or credit == 0:
+                return None
+            if credit < 0: # the command has stopped reading
+                self.close()
+                return None
+            if self.selector and not self.selector.select(0):
+                return None
+            chunks = [os.read(self.fd, credit)]
+            size = len(chunks[0])
+            # a pipe hands over no more than it holds, so keep on while there's more, up to the credit
+            while size and size < credit and self.selector and self.selector.select(0):
+                chunk = os.read(self.fd, credit - size)
+                if not chunk:
+                    break # the end, sent as b'' next time
+                chunks.append(chunk)
+                size += len(chunk)
+            if not size:
+                self.close()
+            return b"".join(chunks)
+
+        def close(self):
+            self.done = True
+            if self.selector:
+                self.selector.close()
+                self.selector = None
+
+    def infile_chunks(infiles, credits):
+        """read the next chunk of each infile, for the ones the server has room for"""
+        chunks = {}
+        for name, fhs in infiles.items():
+            output = []
+            for idx, (fh, credit) in enumerate(zip(fhs, (credits or {}).get(name, ()))):
+                if isinstance(credit, wire.Signature):
+                    fhs[idx] = cli.DeltaReader(fh, credit) # and send deltas from now on
+                    output.append(None)
+                elif fh.closed or credit == 0:
+                    output.append(None)
+                elif credit < 0:
+                    fh.close()
+                    output.append(None)
+                else:
+                    chunk = fh.read(credit)
+                    if not chunk:
+                        fh.close()
+                    output.append(chunk)
+            chunks[name] = output
+        return chunks
+
+    def render_path(argv, environ):
+        """the words that may name subcommands, so only those commands need rendering"""
+        if 'COMP_LINE' in environ and 'COMP_POINT' in environ:
+            words = environ['COMP_LINE'][:int(environ['COMP_POINT'])].split(' ')[1:-1]
+        elif argv and argv[0] == '--version':
+            return None # a version is a hash of the whole tree
+        elif argv and argv[0] == 'help':
+            words = argv[1:]
+        else:
+            words = argv
+        return list(itertools.takewhile(lambda word: not word.startswith('-'), words))
+
+    def completing(environ):
+        """the words before the one being completed, and what's typed of it, when run from bash completion"""
+        arg, offset =  environ['COMP_LINE'], int(environ['COMP_POINT'])
+        tmp = arg[:offset].rsplit(' ', 1)
+        if len(tmp) > 1:
+            return tmp[0].split(' ')[1:], tmp[1]
+        return [], tmp[0]
+
     def run(root, argv, environ):
-        obj = root.render()
+        if 'COMP_LINE' in environ and 'COMP_POINT' in environ and hasattr(root, 'complete'):
+            result = root.complete(*cli.completing(environ))
+            if result is not None:
+                for line in result:
+                    print(line)
+                return 0
+
+        obj = root.render(path=cli.render_path(argv, environ))
 
         if 'COMP_LINE' in environ and 'COMP_POINT' in environ:
-            arg, offset =  environ['COMP_LINE'], int(environ['COMP_POINT'])
-            tmp = arg[:offset].rsplit(' ', 1)
-            if len(tmp) > 1:
-                action = cli.Action('complete', tmp[0].split(' ')[1:], tmp[1])
-            else:
-                action = cli.Action('complete', [], tmp[0])
+            action = cli.Action('complete', *cli.completing(environ))
         elif argv and argv[0] in ("help"):
             argv.pop(0)
             use_help = True
@@ -1098,6 +4137,17 @@ class cli:
             action = obj.parse_args([], argv, environ)
 
     
+        result = None
+        if action.mode in ("call", "error") and hasattr(root, 'connect'):
+            # the tree may have come from a cache, so check it before using it
+            if action.mode == "call" and not any(isinstance(v, wire.FileHandle) for vs in action.argv.values() for v in (vs if isinstance(vs, list) else [vs])):
+                # and without files to open, which depend on the options agreed, call in the same round trip
+                result = root.call_ahead(action.path, action.argv)
+                if result is None:
+                    return cli.run(root, argv, environ)
+            elif root.connect(path=action.path) is not obj:
+                return cli.run(root, argv, environ)
+
         if action.mode == "complete":
             result = obj.complete(action.path, action.argv)
             for line in result:
@@ -1123,7 +4173,7 @@ class cli:
                 exit_code = -len(action.errors)
 
             if result is not None:
-                if isinstance(result, (bytes, bytearray)):
+                if isinstance(result, (bytes, bytearray, memoryview)):
                     sys.stdout.buffer.write(result)
                 else:
                     print(result)
@@ -1135,46 +4185,48 @@ class cli:
         if action.mode != "call":
             raise Exception('no')
 
+        options = getattr(root, 'options', {})
         file_handles = {}
+        infiles = {}
         argv = {}
+        digests = cli.Digests() if options.get('infile_cache') else None
+
+        def open_fh(name, value):
+            if isinstance(value, wire.FileHandle):
+                if value.mode == "read":
+                    if options.get('stream_infiles'):
+                        if name not in infiles:
+                            infiles[name] = []
+                        infiles[name].append(open(value.name, "rb"))
+                        digest = digests.digest(value.name) if digests else None
+                        if digest:
+                            # the full path, as the server keeps the last copy of each name
+                            return wire.FileHandle(os.path.abspath(value.name), "read", digest=digest)
+                        return value
+                    with open(value.name, "rb") as fh:
+                        buf = fh.read()
+                    return wire.FileHandle(value.name, "read", buf=buf)
+                elif value.mode == "write":
+                    fh = open(value.name, "xb")
+                    if name not in file_handles:
+                        file_handles[name] = []
+                    file_handles[name].append(fh)
+                    return value
+            return value
 
         for name, values in action.argv.items():
             if isinstance(values, list):
-                out = []
-                for value in values:
-                    if isinstance(value, wire.FileHandle):
-                        if value.mode == "read":
-                            with open(value.name, "rb") as fh:
-                                buf = fh.read()
-                            out.append(wire.FileHandle(value.name, "read", buf=buf))
-                        elif value.mode == "write":
-                            fh = open(value.name, "xb")
-                            if name not in file_handles:
-                                file_handles[name] = []
-                            file_handles[name].append(fh)
-                            out.append(value)
-                    else:
-                        out.append(value)
-                argv[name] = out
+                argv[name] = [open_fh(name, value) for value in values]
             else:
-                value = values
-                if isinstance(value, wire.FileHandle):
-                    if value.mode == "read":
-                        with open(value.name, "rb") as fh:
-                            buf = fh.read()
-                        argv[name] = wire.FileHandle(value.name, "read", buf=buf)
-                    elif value.mode == "write":
-                        fh = open(value.name, "xb")
-                        if name not in file_handles:
-                            file_handles[name] = []
-                        file_handles[name].append(fh)
-                        argv[name] = value
-                else:
-                    argv[name] = value
+                argv[name] = open_fh(name, values)
+
+        if digests:
+            digests.save()
 
-        os.set_blocking(sys.stdin.fileno(), False)
+        stdin = cli.StdinReader(sys.stdin.fileno())
 
-        result =  root.call(action.path, argv)
+        if result is None:
+            result = root.call(action.path, argv)
 
         while isinstance(result, wire.Session):
             if 'console' in result.file_handles and result.file_handles['console']:
@@ -1188,14 +4240,27 @@ class cli:
                     for idx, fh in enumerate(fhs):
                         fh.write(result.file_handles[name][idx])
             if result.value is not None:
-                r = result.value
-                if isinstance(r, (bytes, bytearray)):
-                    sys.stdout.buffer.write(r)
-                else:
-                    print(r)
+                for r in (result.value if options.get('batch') else [result.value]):
+                    if r is None:
+                        continue # yielded, but there's nothing to print
+                    if isinstance(r, (bytes, bytearray, memoryview)):
+                        sys.stdout.buffer.write(r)
+                    else:
+                        print(r)
                 sys.stdout.flush()
-            result = root.poll(result.idx, file_handles={'stdin': sys.stdin.buffer.read()})
-            time.sleep(0.300) 
+            if options.get('stream_stdin'):
+                credit = (result.credits or {}).get('stdin', 0)
+            else:
+                credit = cli.InputStream.CHUNK # still bounded, for servers that write it all out at once
+            request = {'stdin': stdin.read(credit)}
+            if infiles:
+                request.update(cli.infile_chunks(infiles, result.credits))
+            result = root.poll(result.idx, file_handles=request)
+
+        stdin.close()
+        for fhs in infiles.values():
+            for fh in fhs:
+                fh.close()
 
         if 'console' in result.file_handles and result.file_handles['console']:
             line = result.file_handles['console']
@@ -1219,7 +4284,7 @@ class cli:
 
         if result is not None:
             for r in result:
-                if isinstance(r, (bytes, bytearray)):
+                if isinstance(r, (bytes, bytearray, memoryview)):
                     sys.stdout.buffer.write(r)
                 else:
                     print(r)